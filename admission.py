@@ -0,0 +1,124 @@
+# admission.py
+# Admission control for the web requests that do heavy work. Each kind of work has a fixed
+# number of slots with a bounded queue in front of them: 'images' (decoding and encoding
+# uploads, CPU bound) and 'sends' (posting right away, network bound). A request that finds
+# the queue full is turned away at once with 429, one that waits longer than MAX_WAIT for a
+# slot with 503, both with a Retry-After, so a burst is shed instead of piling up memory and
+# file descriptors. Scheduled posts are not affected. State is kept per process; gunicorn.conf.py
+# runs one threaded worker by default, so these are the limits of the whole app.
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import aio
+import configLog
+
+logger, speed_logger = configLog.configure_logging()
+
+IMAGES = 'images'
+SENDS = 'sends'
+
+# The cores are shared by the workers gunicorn.conf.py starts
+IMAGE_SLOTS = max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1)))
+SEND_SLOTS = aio.MAX_CONCURRENT_POSTS
+QUEUE_SIZE = 16       # requests allowed to wait for a slot, per kind of work
+MAX_WAIT = 10.0       # seconds a queued request waits for a slot before it is turned away
+MAX_RETRY_AFTER = 60
+SMOOTHING = 0.2       # weight of the newest sample in the moving averages
+
+class Overloaded(Exception):
+    def __init__(self, name, status, retry_after):
+        reason = 'queue is full' if status == 429 else 'no slot became free in time'
+        super().__init__(f'{name} {reason}, retry after {retry_after} s')
+        self.name = name
+        self.status = status
+        self.retry_after = retry_after
+
+class Gate:
+    # A counting semaphore that knows how many are waiting on it and for how long
+    def __init__(self, name, slots, queue_size=QUEUE_SIZE, max_wait=MAX_WAIT):
+        self.name = name
+        self.slots = slots
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.avg_wait = 0.0
+        self.max_seen_wait = 0.0
+        self.avg_service = 1.0  # seconds a request holds a slot; a guess until the first one is done
+        self._cond = threading.Condition()
+
+    def retry_after(self):
+        # Roughly the time until everyone queued now has had their turn
+        seconds = (self.waiting + 1) / self.slots * self.avg_service
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(seconds)))
+
+    @contextmanager
+    def admit(self):
+        start = time.monotonic()
+        with self._cond:
+            if self.active >= self.slots and self.waiting >= self.queue_size:
+                self.rejected += 1
+                raise Overloaded(self.name, 429, self.retry_after())
+            self.waiting += 1
+            try:
+                free = self._cond.wait_for(lambda: self.active < self.slots, self.max_wait)
+            finally:
+                self.waiting -= 1
+            if not free:
+                self.timed_out += 1
+                raise Overloaded(self.name, 503, self.retry_after())
+            self.active += 1
+            self.admitted += 1
+            waited = time.monotonic() - start
+            self.avg_wait += SMOOTHING * (waited - self.avg_wait)
+            self.max_seen_wait = max(self.max_seen_wait, waited)
+        if waited >= 0.1:
+            speed_logger.info(f'{self.name} admission wait: {waited} seconds')
+        try:
+            yield waited
+        finally:
+            with self._cond:
+                self.active -= 1
+                self.avg_service += SMOOTHING * (time.monotonic() - start - waited - self.avg_service)
+                self._cond.notify()
+
+    def status(self):
+        with self._cond:
+            return {
+                'slots': self.slots,
+                'active': self.active,
+                'queued': self.waiting,
+                'queue_size': self.queue_size,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'avg_wait_ms': round(self.avg_wait * 1000),
+                'max_wait_ms': round(self.max_seen_wait * 1000),
+                'avg_service_ms': round(self.avg_service * 1000),
+            }
+
+_gates = {
+    IMAGES: Gate(IMAGES, IMAGE_SLOTS),
+    SENDS: Gate(SENDS, SEND_SLOTS),
+}
+
+def configure(image_slots=None, send_slots=None, queue_size=None, max_wait=None):
+    # Called once from create_app, before any request is served
+    _gates[IMAGES].slots = image_slots or IMAGE_SLOTS
+    _gates[SENDS].slots = send_slots or SEND_SLOTS
+    for gate in _gates.values():
+        gate.queue_size = queue_size if queue_size is not None else QUEUE_SIZE
+        gate.max_wait = max_wait or MAX_WAIT
+
+def admit(name):
+    # with admission.admit(admission.IMAGES): ... raises Overloaded when the work has to be refused
+    return _gates[name].admit()
+
+def status():
+    return {name: gate.status() for name, gate in _gates.items()}
@@ -0,0 +1,116 @@
+# aio.py
+# Shared asyncio engine for the platform modules: one event loop running in a background
+# thread per process and one pooled async HTTP client (HTTP/2 when the h2 package is
+# installed). Request handlers and scheduler jobs hand their coroutines to this loop,
+# so many posts and uploads share the same loop and connections.
+import asyncio
+import contextvars
+import threading
+
+import httpx
+
+try:
+    import h2  # noqa: F401 - only needed to enable HTTP/2 in httpx
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+MAX_CONNECTIONS = 50
+MAX_CONCURRENT_POSTS = 8      # posts being fanned out at the same time
+MAX_CONCURRENT_UPLOADS = 8    # media uploads in flight per platform
+# Explicit limits for every phase: a dead host fails in seconds, uploads get longer to write
+REQUEST_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=60.0, pool=10.0)
+PROBE_TIMEOUT = httpx.Timeout(5.0)
+
+_loop = None
+_loop_lock = threading.Lock()
+_client = None
+_semaphores = {}
+_outages = contextvars.ContextVar('outages', default=None)
+_answers = contextvars.ContextVar('answers', default=None)
+
+class OutageTransport(httpx.AsyncBaseTransport):
+    # Notes transport errors (timeouts, refused connections, ...) and 5xx answers for
+    # track_outages; 4xx answers mean the service is up and just refused the request.
+    # The status of every answer is noted as well, see answers()
+    def __init__(self, transport):
+        self._transport = transport
+
+    async def handle_async_request(self, request):
+        try:
+            response = await self._transport.handle_async_request(request)
+        except httpx.TransportError as e:
+            report_outage(f'{request.url.host}: {type(e).__name__}')
+            raise
+        answers = _answers.get()
+        if answers is not None:
+            answers.append(response.status_code)
+        if response.status_code >= 500:
+            report_outage(f'{request.url.host}: HTTP {response.status_code}')
+        return response
+
+    async def aclose(self):
+        await self._transport.aclose()
+
+def get_loop():
+    # Started lazily so that it is created inside each gunicorn worker, not in the master before fork
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='aio-event-loop', daemon=True).start()
+    return _loop
+
+def run(coro):
+    # Run a coroutine on the shared loop from synchronous code and wait for its result
+    return asyncio.run_coroutine_threadsafe(coro, get_loop()).result()
+
+def get_client():
+    # Must be called from the shared loop
+    global _client
+    if _client is None:
+        transport = httpx.AsyncHTTPTransport(http2=HTTP2_AVAILABLE, limits=httpx.Limits(max_connections=MAX_CONNECTIONS))
+        _client = httpx.AsyncClient(transport=OutageTransport(transport), timeout=REQUEST_TIMEOUT)
+    return _client
+
+def track_outages():
+    # Collect the outages the calling task (and the tasks and threads it starts) runs into;
+    # returns the list they are appended to
+    outages = []
+    _outages.set(outages)
+    _answers.set([])
+    return outages
+
+def answers():
+    # Status codes of the HTTP answers the current tracked call got so far, oldest first
+    return _answers.get() or []
+
+async def untracked(coro):
+    # Run coro in a task of its own whose outages are not charged to the calling platform call,
+    # e.g. link card fetches from third-party sites
+    async def run():
+        _outages.set(None)
+        _answers.set(None)
+        return await coro
+    return await asyncio.ensure_future(run())
+
+def report_outage(reason):
+    # Also for clients that don't go through get_client(), e.g. smtplib in posthaven.py
+    outages = _outages.get()
+    if outages is not None:
+        outages.append(reason)
+
+def semaphore(name, limit):
+    # Named semaphores bound to the shared loop, e.g. semaphore('facebook', MAX_CONCURRENT_UPLOADS)
+    if name not in _semaphores:
+        _semaphores[name] = asyncio.Semaphore(limit)
+    return _semaphores[name]
+
+async def reachable(url):
+    # Health probe: any answer below 500 means the service is up, even if it refuses us
+    response = await get_client().get(url, timeout=PROBE_TIMEOUT)
+    return response.status_code < 500
+
+async def bounded(name, limit, coro):
+    async with semaphore(name, limit):
+        return await coro
@@ -1,4 +1,5 @@
 # Python Standard Library
+import io
 import os
 import time
 import inspect
@@ -8,92 +9,152 @@ from datetime import datetime
 # Third-Party Libraries
 import pytz
 from PIL import Image
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from flask_session import Session  # if you're using flask-session
-from flask_apscheduler import APScheduler
-from flask_sqlalchemy import SQLAlchemy
-from flask import g
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, current_app
 from sqlalchemy import inspect
 #from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 #from apscheduler.triggers.date import DateTrigger
 
 # Your Applications/Library specific modules
 import helpers
-from config import Config, MYPASSWORD
-from models import ScheduledPosts
-from extensions import db
+import admission
+import auth
+import bulk
+import dashboard
+import history
+import leader
+import media
+import preview
+import breaker
+import platforms
+import render
+import sessions
+import validation
 from config import Config
+from models import ScheduledPosts, PLATFORMS, upgrade_schema
+from extensions import db, scheduler, server_session
 import configLog
 
-def create_app():
+# Setup logging
+logger, speed_logger = configLog.configure_logging()
+
+bp = Blueprint('main', __name__)
+
+def create_app(start_scheduler=True):
+    # Nothing happens at import time: the app, its database and the scheduler are only
+    # set up here (see wsgi.py for the gunicorn entry point)
     app = Flask(__name__)
     app.config.from_object(Config)
     
+    breaker.configure(app.config.get('BREAKER_FAILURE_THRESHOLD'), app.config.get('BREAKER_LATENCY_SLO'),
+                      app.config.get('BREAKER_RETRY_DELAY'))
+    admission.configure(app.config.get('ADMISSION_IMAGE_SLOTS'), app.config.get('ADMISSION_SEND_SLOTS'),
+                        app.config.get('ADMISSION_QUEUE_SIZE'), app.config.get('ADMISSION_MAX_WAIT'))
+
     # Initialize db with app
     db.init_app(app)
     
     with app.app_context():
         db.create_all()
+        upgrade_schema()
         inspector = inspect(db.engine)
         table_exists = inspector.has_table(ScheduledPosts.__tablename__)
         if table_exists:
-            print("ScheduledPosts table exists in the database.")
+            logger.debug("ScheduledPosts table exists in the database.")
         else:
-            print("ScheduledPosts table does not exist in the database.")
+            logger.error("ScheduledPosts table does not exist in the database.")
 
-    return app
-
-app = create_app()
-flask_app = app
-
-Session(app)
-
-# Setup logging
-logger, speed_logger = configLog.configure_logging()
+    if app.config.get('SESSION_TYPE') == 'memory':
+        app.session_interface = sessions.MemorySessionInterface()
+    else:
+        server_session.init_app(app)
+    # Static files and token requests skip the session, see sessions.py
+    app.session_interface = sessions.SelectiveSessionInterface(app.session_interface)
+    if not app.config.get('API_TOKEN_SECRET'):
+        logger.warning('API_TOKEN_SECRET is not set, API tokens are disabled')
+    app.register_blueprint(bp)
+
+    # Scheduler object to allow scheduling of tasks. Jobs that come due while no worker is
+    # dispatching (e.g. during a leader hand-over) still run once a scheduler picks them up.
+    app.config.setdefault('SCHEDULER_JOB_DEFAULTS', {'misfire_grace_time': 300, 'coalesce': True})
+    scheduler.init_app(app)
+    logger.debug('Scheduler initialized')
+    if start_scheduler:
+        if app.config.get('SCHEDULER_MODE', 'standalone') == 'leader':
+            # Several workers/hosts share the job store; only the lease holder dispatches
+            leader.start_leader_election(app)
+            logger.debug('Scheduler started paused, waiting for leader election')
+        else:
+            scheduler.start()
+            logger.debug('Scheduler started')
 
-# Scheduler object to allow scheduling of tasks
-scheduler = APScheduler()
-scheduler.init_app(app)
-logger.debug('Scheduler initialized')
-scheduler.start()
-logger.debug('Scheduler started')
+    return app
 
-@app.errorhandler(502)
+@bp.app_errorhandler(502)
 def handle_bad_gateway_error(e):
     logger.error('Bad Gateway error: %s', str(e))
-    logger.error('Request data: %s', request.data)
+    logger.error('Request data: %s', configLog.payload(request.get_data(cache=True)))
     return 'Bad Gateway', 502
 
-@app.route('/')
+@bp.app_errorhandler(admission.Overloaded)
+def handle_overloaded(e):
+    # Shed the request early and tell the client when to come back, see admission.py
+    logger.warning('Request to %s refused: %s', request.path, e)
+    headers = {'Retry-After': str(e.retry_after)}
+    if request.path.startswith('/api/') or request.path == '/bulk' or auth.bearer_token() is not None:
+        return jsonify({'error': 'server busy, try again later', 'retry_after': e.retry_after}), e.status, headers
+    return f'The server is busy, please try again in {e.retry_after} seconds.', e.status, headers
+
+@bp.route('/')
 def index():
-    version = app.config['VERSION']
+    version = current_app.config['VERSION']
     logger.info('Index page loaded')
-    if 'logged_in' not in session:
-        return redirect(url_for('login'))
+    if not auth.authenticated():
+        return redirect(url_for('main.login'))
     return render_template('index.html', version=version)
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         password = request.form.get('password')
-        if password == MYPASSWORD:
+        if auth.check_password(password):
             session['logged_in'] = True
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         else:
             return "Incorrect password, try again."
     return render_template('login.html')
 
-@app.route('/submit', methods=['POST'])
+def _submit_error(api, message, status=400):
+    # Scripts using an API token get JSON, the form a flashed message
+    if api:
+        return jsonify({'error': message}), status
+    flash(f'Error: {message}')
+    return redirect(url_for('main.index'))
+
+def _submit_results(post_key):
+    # {platform: {'status', 'url'}} of this post's latest sends, from history
+    results = {}
+    for row in history.list_history(post_key):
+        results.setdefault(row['platform'], {'status': row['status'], 'url': row['url']})
+    return results
+
+@bp.route('/submit', methods=['POST'])
 def submit_form():
+    api = auth.bearer_token() is not None
+    if not auth.authenticated():
+        if api:
+            return jsonify({'error': 'invalid or expired API token'}), 401
+        return redirect(url_for('main.login'))
 
-    timezone = pytz.timezone('Europe/Berlin')  # Replace 'Your_Timezone' with your desired timezone
+    timezone = request.form.get('timezone') or current_app.config.get('DEFAULT_TIMEZONE', helpers.DEFAULT_TIMEZONE)
 
     start_time = time.time()
 
     scheduled_time = request.form.get('scheduled_time')
     if scheduled_time:
-        scheduled_time = datetime.strptime(scheduled_time, '%Y-%m-%dT%H:%M')
-        scheduled_time = timezone.localize(scheduled_time)
+        try:
+            scheduled_time = helpers.parse_scheduled_time(scheduled_time, timezone)
+        except (ValueError, pytz.UnknownTimeZoneError) as e:
+            return _submit_error(api, str(e))
         logger.info('Scheduled Time: %s', scheduled_time)  # Log message
     else:
         scheduled_time = None
@@ -101,29 +162,23 @@ def submit_form():
     if start_time is None:
         start_time = time.time()
    
-    text = request.form['text']
-    text_html = "<br>".join(text.splitlines())  # Convert line breaks to <br> tags
-    text_html = helpers.urls_to_html_links(text_html)  # Convert URLs to links
-
     hashtag = request.form.get('hashtagCheckbox')  # get the value of hashtagCheckbox
     hashtag_text = request.form.get('txt_hashtags')  # get the value of txt_hashtags
 
     # Check if any images have been selected and if any of them have alt text
     files = request.files.getlist('files')
     alt_texts = [request.form.get('alt_text_' + str(i)) for i in range(len(files))]
-    if files and any(alt_texts):
-        text += '\n\n[prompt in the alt]'
 
-    if hashtag == 'on':  # if checkbox is checked, append hashtag_text
-        text += '\n\n' + hashtag_text
+    text, text_html, text_mastodon, subject = helpers.build_post_texts(
+        request.form['text'],
+        hashtag_text if hashtag == 'on' else None,  # if checkbox is checked, append hashtag_text
+        bool(files and any(alt_texts)),
+        timezone,
+    )
 
-    text_mastodon = "\n".join(text.splitlines())  # Convert line breaks to \n for Mastodon
-    
-    text = f'<big>{text_html}</big><hr>'
-
-    files = request.files.getlist('files')
+    files = [file for file in files if file.filename]  # an empty file input still sends one nameless part
     logger.info('files: %s', files)
-    textOnly = False
+    textOnly = not files
 
     if files:  # this block will execute if any files have been uploaded
         new_names = [request.form.get('new_name_' + str(i)) for i in range(len(files))]
@@ -136,9 +191,6 @@ def submit_form():
             file.filename = new_name
             logger.info('file.filename: %s', file.filename)
 
-        # Get alt texts
-        alt_texts = [request.form.get('alt_text_' + str(i)) for i in range(len(files))]
-
         # Combine files and alt_texts into a list of tuples
         file_alt_text_pairs = list(zip(files, alt_texts))
 
@@ -148,28 +200,8 @@ def submit_form():
 
         # Unzip the list of tuples back into files and alt_texts using list comprehensions
         files, alt_texts = [list(t) for t in zip(*file_alt_text_pairs)]
-
-        # Error handling for file upload limit
-        if len(files) > 4:
-            flash('Error: Maximum of 4 files are allowed.')
-            return redirect(url_for('index'))
-
-        # Process files and store resized images
-        processed_files, processed_alt_texts, image_locations = process_files(files, alt_texts, scheduled_time) # Get image_locations
-        logger.debug('Files after processing: %s', ', '.join(filename for filename, _ in processed_files))
     else:
-        processed_files = []
-        processed_alt_texts = []
-        textOnly = True
-
-    # Create the email subject
-    now = datetime.now(timezone)
-    # Extract the first 10 characters from the 'text' field
-    text_preview = helpers.strip_html_tags(text[:10])
-    # Format the current time as 'year/month/day'
-    date_str = now.strftime('%Y/%m/%d')
-    # Create the subject string
-    subject = f'[{date_str}] {text_preview} ...'
+        alt_texts = []
 
     # Update the enable variables based on checkbox values
     enable_twitter = request.form.get('chkTW') == 'on'
@@ -193,56 +225,278 @@ def submit_form():
         "enable_bluesky": enable_bluesky,
         "enable_mastodon": enable_mastodon,
         "enable_facebook": enable_facebook,
-        "processed_files": processed_files,
-        "processed_alt_texts": processed_alt_texts,
-        "image_locations": image_locations,
+        "processed_files": [],
+        "processed_alt_texts": alt_texts,
+        "image_locations": [],
         "scheduled_time": scheduled_time,
         "textOnly": textOnly
     }
 
-    if scheduled_time:
+    # Pre-flight: render every platform's final text once and check texts, image headers and
+    # required fields against every enabled platform before any image work or upload
+    render.prepare(post_data, current_app.config.get('TRUNCATE_OVERLONG_POSTS', False))
+    inspected = [validation.inspect_media(file.stream, file.filename) for file in files]
+    errors = validation.validate_post(post_data, inspected, current_app.config.get('REQUIRE_ALT_TEXT', False))
+    if errors:
+        return _submit_error(api, ' '.join(errors))
+
+    videos = []
+    if files:
+        # Process files and store resized images
+        try:
+            with admission.admit(admission.IMAGES):
+                processed_files, processed_alt_texts, image_locations, videos = process_files(
+                    files, alt_texts, scheduled_time, validation.enabled_platforms(post_data))  # Get image_locations
+        except media.MediaError as e:
+            return _submit_error(api, str(e))
+        logger.debug('Files after processing: %s', ', '.join(filename for filename, _ in processed_files))
+        post_data.update(processed_files=processed_files, processed_alt_texts=processed_alt_texts, image_locations=image_locations)
+
+        # The size of the JPEGs that will actually be uploaded is only known now; videos are checked once transcoded
+        try:
+            errors = validation.validate_processed_media(
+                post_data, [path for path, _ in processed_files if not media.is_video(path)])
+        except media.MediaError as e:
+            errors = [str(e)]
+        if errors:
+            helpers.remove_post_images(post_data)
+            return _submit_error(api, ' '.join(errors))
+
+    if videos:
+        # The post is sent, or put in the queue, by a job once its videos are transcoded
+        helpers.queue_transcode(post_data, videos, current_app.config.get('PRESTAGE_LEAD_SECONDS', 600))
+        if not api:
+            flash('The video is being converted, the post goes out once it is ready.')
+        result, status = {
+            'post_key': post_data['post_key'],
+            'processing': True,
+            'scheduled_time': scheduled_time.astimezone(pytz.utc).isoformat() if scheduled_time else None,
+        }, 202
+    elif scheduled_time:
         # Convert string time to datetime object
         try:
             #scheduled_time = datetime.strptime(scheduled_time, '%Y-%m-%dT%H:%M:%S%z')  # Notice the added :%S%z
             logger.info('Scheduled Time: %s', scheduled_time)  # Log message
         except ValueError:
             logger.info('Error: Scheduled Time format is incorrect.')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
 
         # Convert local time to UTC
         utc_dt = scheduled_time.astimezone(pytz.utc)
 
         # Schedule post for later
-        with app.app_context():
+        with current_app.app_context():
             post = helpers.save_post_to_database(post_data)  # Get the post object
             if post is None:
                 # If post is None, there was an error saving it to the database, so we skip scheduling the post
                 logger.error('Post could not be saved to the database, skipping scheduling.')
-                return redirect(url_for('index'))
+                if api:
+                    return jsonify({'error': 'the post could not be saved'}), 500
+                return redirect(url_for('main.index'))
             logger.debug('Post saved to the database')
 
-            job_id = str(post.id)
-            scheduler.add_job(id=job_id, func='helpers:send_scheduled_post', args=[post.id], trigger='date', run_date=utc_dt)
+            helpers.add_post_jobs(post.id, utc_dt, current_app.config.get('PRESTAGE_LEAD_SECONDS', 600))
             logger.debug('Scheduled post added to the job queue')
 
         logger.debug('Your post has been scheduled.')
+        result, status = {'post_id': post.id, 'post_key': post_data['post_key'], 'scheduled_time': utc_dt.isoformat()}, 202
     else:
-        # Post immediately
-        helpers.send_post(post_data)
+        # Post immediately; platforms whose circuit breaker is open are retried later
+        try:
+            with admission.admit(admission.SENDS):
+                deferred = helpers.send_post(post_data)
+        except admission.Overloaded:
+            helpers.remove_post_images(post_data)
+            raise
+        retry_time = None
+        if deferred:
+            retry_time = helpers.schedule_retry(post_data, deferred)
+            names = ', '.join(platforms.display_name(platform) for platform in deferred)
+            if retry_time:
+                flash(f'{names} is unavailable right now, the post will be retried there automatically.')
+            else:
+                flash(f'{names} is unavailable right now.')
+        result, status = {
+            'post_key': post_data['post_key'],
+            'platforms': _submit_results(post_data['post_key']),
+            'deferred': deferred,
+            'retry_time': retry_time.isoformat() if retry_time else None,
+        }, 202 if deferred else 200
 
     end_time = time.time()
     speed_logger.info(f"OVERALL execution time: {end_time-start_time} seconds")
 
-    return redirect(url_for('index'))
+    if api:
+        return jsonify(result), status
+    return redirect(url_for('main.index'))
+
+@bp.route('/bulk', methods=['POST'])
+def bulk_schedule():
+    if not auth.authenticated():
+        return jsonify({'errors': [{'index': None, 'error': 'not logged in'}]}), 401
 
-def process_files(files, alt_texts, scheduled_time):
+    manifest = request.files.get('manifest')
+    if manifest:
+        data, filename = manifest.read(), manifest.filename
+    else:
+        data, filename = request.get_data(), ''
+
+    try:
+        with admission.admit(admission.IMAGES):
+            post_ids = bulk.import_manifest(current_app._get_current_object(), scheduler, data, filename)
+    except bulk.ManifestError as e:
+        logger.info('Bulk manifest rejected: %s', e)
+        return jsonify({'errors': e.errors}), 400
+
+    return jsonify({'scheduled': len(post_ids), 'post_ids': post_ids})
+
+def _queue_page_args():
+    try:
+        limit = int(request.args.get('limit', dashboard.DEFAULT_PAGE_SIZE))
+    except ValueError:
+        limit = dashboard.DEFAULT_PAGE_SIZE
+    return {
+        'platform': request.args.get('platform') or None,
+        'status': request.args.get('status') or None,
+        'after': request.args.get('after') or None,
+        'limit': limit,
+    }
+
+@bp.route('/queue')
+def queue():
+    if not auth.authenticated():
+        return redirect(url_for('main.login'))
+    args = _queue_page_args()
+    try:
+        posts, next_cursor = dashboard.list_scheduled_posts(**args)
+    except ValueError:
+        return 'Invalid cursor', 400
+    return render_template('queue.html', version=current_app.config['VERSION'], posts=posts, next_cursor=next_cursor,
+                           counts=dashboard.queue_counts(), platforms=dashboard.PLATFORMS, filters=args)
+
+@bp.route('/api/queue')
+def api_queue():
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    try:
+        posts, next_cursor = dashboard.list_scheduled_posts(**_queue_page_args())
+    except ValueError:
+        return jsonify({'error': 'invalid cursor'}), 400
+    return jsonify({'posts': posts, 'next_cursor': next_cursor})
+
+@bp.route('/api/token', methods=['POST'])
+def api_token():
+    # A signed API token for scripts, for a logged in user or in exchange for the password
+    if not (auth.authenticated() or auth.check_password(request.form.get('password'))):
+        return jsonify({'error': 'not logged in'}), 401
+    if not auth.tokens_enabled():
+        return jsonify({'error': 'API tokens are disabled, set API_TOKEN_SECRET in config.py'}), 503
+    return jsonify({'token': auth.issue_token(),
+                    'expires_in': current_app.config.get('API_TOKEN_MAX_AGE', auth.TOKEN_MAX_AGE)})
+
+@bp.route('/api/health')
+def api_health():
+    # Circuit breaker state of every platform in this worker
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    return jsonify(breaker.status())
+
+@bp.route('/api/load')
+def api_load():
+    # Slots, queue depth and wait times of the admission gates of the worker that answers
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    return jsonify(admission.status())
+
+@bp.route('/api/history')
+def api_history():
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    platform = request.args.get('platform')
+    if platform and platform not in PLATFORMS:
+        return jsonify({'error': f'unknown platform {platform}'}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+    except ValueError:
+        return jsonify({'error': 'invalid limit'}), 400
+    return jsonify({'history': history.list_history(request.args.get('post_key'), platform, limit)})
+
+@bp.route('/api/history/<post_key>/delete', methods=['POST'])
+def api_delete_post(post_key):
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    outcome, _ = helpers.change_post(post_key, 'delete')
+    if not outcome:
+        return jsonify({'error': 'no published post with this key'}), 404
+    return jsonify({'platforms': outcome})
+
+@bp.route('/api/history/<post_key>/edit', methods=['POST'])
+def api_edit_post(post_key):
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    text = (request.get_json(silent=True) or {}).get('text') or request.form.get('text')
+    if not text:
+        return jsonify({'error': 'text is required'}), 400
+    outcome, errors = helpers.change_post(post_key, 'edit', text, current_app.config.get('TRUNCATE_OVERLONG_POSTS', False))
+    if errors:
+        return jsonify({'error': ' '.join(errors)}), 400
+    if not outcome:
+        return jsonify({'error': 'no published post with this key'}), 404
+    return jsonify({'platforms': outcome})
+
+@bp.route('/api/history/stats')
+def api_history_stats():
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    since = request.args.get('since')
+    try:
+        since = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return jsonify({'error': 'invalid since, expected an ISO date'}), 400
+    return jsonify(history.platform_stats(since))
+
+@bp.route('/api/preview', methods=['POST'])
+def api_preview():
+    # Low resolution preview of what will be posted, plus the per-platform checks of the image
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({'error': 'no file uploaded'}), 400
+
+    data = file.read()
+    image = validation.inspect_image(io.BytesIO(data), file.filename)
+    if image.get('error'):
+        return jsonify({'error': image['error']}), 413
+    if image['format'] not in validation.SUPPORTED_FORMATS:
+        return jsonify({'error': f"unsupported file format {image['format'] or '(not an image)'}"}), 415
+
+    with admission.admit(admission.IMAGES):
+        digest, info = preview.get_preview(current_app.root_path, data,
+                                           current_app.config.get('PREVIEW_CACHE_ENTRIES', preview.PREVIEW_CACHE_ENTRIES))
+    info['hash'] = digest
+    info['url'] = url_for('static', filename=f'temp/previews/{digest}.jpg')
+    info['platforms'] = {platform: validation.image_errors(platform, image, info['bytes'])
+                         for platform in validation.MEDIA_LIMITS}
+    return jsonify(info)
+
+@bp.route('/api/queue/counts')
+def api_queue_counts():
+    if not auth.authenticated():
+        return jsonify({'error': 'not logged in'}), 401
+    return jsonify(dashboard.queue_counts())
+
+def process_files(files, alt_texts, scheduled_time, platforms=()):
+    # Images become JPEGs. Videos and animated GIFs are only saved: the last value lists what
+    # helpers.queue_transcode has to transcode for the given platforms, see media.py
     if not files or files[0].filename == '':
-        return [], [], []
+        return [], [], [], []
 
     processed_files = []
     processed_alt_texts = []
     image_locations = []
-    temp_dir = os.path.join(app.root_path, 'static/temp')
+    videos = []
+    temp_dir = os.path.join(current_app.root_path, 'static/temp')
 
     if scheduled_time:
         # Create a subfolder based on the scheduled time
@@ -256,12 +510,32 @@ def process_files(files, alt_texts, scheduled_time):
 
     for (file, alt_text) in zip(files, alt_texts):
         try:
-            image = Image.open(file).convert("RGB")
-            filename = urllib.parse.quote(os.path.splitext(file.filename)[0]) + '.jpg'
-            temp_file_path = os.path.join(temp_dir, filename)
-
-            image.save(temp_file_path, 'JPEG', quality=90)
-            logger.info('Saved processed image: %s', temp_file_path)
+            basename = urllib.parse.quote(os.path.splitext(file.filename)[0])
+            if media.sniff(file.stream) == media.KIND_VIDEO:
+                # The upload is streamed to disk; ffmpeg reads it from there later, see helpers.transcode_post
+                source_path = os.path.join(temp_dir, basename + '.source')
+                file.save(source_path)
+                filename = media.variant_name(basename, media.variant_profiles(platforms)[0])
+                temp_file_path = os.path.join(temp_dir, filename)
+                processed_files.append((temp_file_path, None))
+                videos.append((source_path, temp_dir, basename))
+                logger.info('Saved video for transcoding: %s', source_path)
+            else:
+                filename = basename + '.jpg'
+                temp_file_path = os.path.join(temp_dir, filename)
+
+                # Uploads that were previewed have usually been encoded already, see preview.py
+                data = file.read()
+                file.seek(0)
+                if preview.copy_encoded(current_app.root_path, data, temp_file_path):
+                    logger.info('Reused encoded image: %s', temp_file_path)
+                else:
+                    image = Image.open(file).convert("RGB")
+                    image.save(temp_file_path, 'JPEG', quality=preview.JPEG_QUALITY)
+                    logger.info('Saved processed image: %s', temp_file_path)
+
+                with open(temp_file_path, 'rb') as img_file:
+                    processed_files.append((temp_file_path, helpers.resize_image(img_file)))
 
             #if scheduled_time:
             image_url = url_for('static', filename=f'temp/{folder_name}/{filename}', _external=True)
@@ -270,18 +544,17 @@ def process_files(files, alt_texts, scheduled_time):
             image_locations.append(image_url)
             logger.info('Appended image URL: %s', image_url)
 
-            with open(temp_file_path, 'rb') as img_file:
-                processed_files.append((temp_file_path, helpers.resize_image(img_file)))
             processed_alt_texts.append(alt_text)
             logger.info('Processed file: %s', temp_file_path)
 
         except Exception as e:
             logger.debug(f"Unable to process one of the attachments. Error: {e}")
+            helpers.remove_temp_folder(temp_dir)
             raise
 
-    return processed_files, processed_alt_texts, image_locations
+    return processed_files, processed_alt_texts, image_locations, videos
 
 
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,62 @@
+# auth.py
+# Who may use the app: the UI logs in with the password and keeps 'logged_in' in its session,
+# scripts send a signed API token as 'Authorization: Bearer <token>'. Tokens are stateless:
+# verifying one is an HMAC check, no session or database is read. They are signed with
+# API_TOKEN_SECRET, which every worker must share; changing it revokes every token. Without
+# it tokens are disabled: SECRET_KEY is usually random per worker and restart.
+import hmac
+
+from flask import current_app, request, session
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+from werkzeug.security import check_password_hash
+
+import configLog
+from config import MYPASSWORD
+
+logger, speed_logger = configLog.configure_logging()
+
+TOKEN_SALT = 'api-token'
+TOKEN_MAX_AGE = 30 * 24 * 60 * 60
+
+def tokens_enabled():
+    return bool(current_app.config.get('API_TOKEN_SECRET'))
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.config['API_TOKEN_SECRET'], salt=TOKEN_SALT)
+
+def check_password(password):
+    # PASSWORD_HASH (werkzeug.security.generate_password_hash) is preferred over the plain MYPASSWORD
+    if not password:
+        return False
+    password_hash = current_app.config.get('PASSWORD_HASH')
+    if password_hash:
+        return check_password_hash(password_hash, password)
+    return hmac.compare_digest(password.encode('utf-8'), MYPASSWORD.encode('utf-8'))
+
+def issue_token(name='api'):
+    return _serializer().dumps({'sub': name})
+
+def verify_token(token):
+    if not tokens_enabled():
+        return False
+    try:
+        _serializer().loads(token, max_age=current_app.config.get('API_TOKEN_MAX_AGE', TOKEN_MAX_AGE))
+    except SignatureExpired:
+        logger.info('Expired API token refused')
+        return False
+    except BadSignature:
+        logger.warning('Invalid API token refused for %s', request.path)
+        return False
+    return True
+
+def bearer_token():
+    # The token of this request, or None if it has no bearer Authorization header
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return token.strip() if scheme.lower() == 'bearer' and token.strip() else None
+
+def authenticated():
+    # Token requests never look at the session, see sessions.py
+    token = bearer_token()
+    if token is not None:
+        return verify_token(token)
+    return bool(session.get('logged_in'))
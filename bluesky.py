@@ -1,73 +1,196 @@
-import helpers
+import asyncio
+import richtext
+import os
+import aio
+import media
+import linkcards
 import configLog
-from atproto import Client, models
-from datetime import datetime
+from datetime import datetime, timezone
 from config import (BLUESKY_EMAIL, BLUESKY_PASSWORD)
 from urllib.parse import urlparse
 
 logger, speed_logger = configLog.configure_logging()
 
-client = Client()
+PDS_URL = 'https://bsky.social'
 
-def login_to_bluesky():
-    global client
+# createSession is rate limited, so the session is kept and only renewed once it expires
+session = None
+
+# Thumbnail blobs of link cards by image URL; a blob that a post references can be referenced again
+thumb_blobs = linkcards.LRUCache()
+
+async def login_to_bluesky():
+    global session
+    r = await aio.get_client().post(f'{PDS_URL}/xrpc/com.atproto.server.createSession',
+                                    json={'identifier': BLUESKY_EMAIL, 'password': BLUESKY_PASSWORD})
+    r.raise_for_status()
+    session = r.json()
+    logger.debug("Successfully logged in to Bluesky.")
+    return session
+
+def error_name(response):
     try:
-        client.login(BLUESKY_EMAIL, BLUESKY_PASSWORD)
-        logger.debug("Successfully logged in to Bluesky.")
-    except Exception as e:
-        logger.error(f"Failed to log in to Bluesky: {e}")
+        return response.json().get('error')
+    except ValueError:
+        return None
 
-from urllib.parse import urlparse
+async def xrpc_post(method, headers=None, content_stream=None, **kwargs):
+    # POST to an XRPC procedure with the current session, logging in again once if the token has expired.
+    # content_stream is a function returning a fresh async iterator of the body, for streamed uploads.
+    for attempt in range(2):
+        current = session or await login_to_bluesky()
+        auth_headers = dict(headers or {}, Authorization=f"Bearer {current['accessJwt']}")
+        if content_stream is not None:
+            kwargs['content'] = content_stream()
+        r = await aio.get_client().post(f'{PDS_URL}/xrpc/{method}', headers=auth_headers, **kwargs)
+        if attempt == 0 and r.status_code in (400, 401) and error_name(r) == 'ExpiredToken':
+            await login_to_bluesky()
+            continue
+        r.raise_for_status()
+        return r.json()
+
+async def resolve_handles(handles):
+    # Mention facets need DIDs; resolve all handles of a post concurrently and skip unknown ones
+    async def resolve(handle):
+        try:
+            r = await aio.get_client().get(f'{PDS_URL}/xrpc/com.atproto.identity.resolveHandle', params={'handle': handle})
+            r.raise_for_status()
+            return handle.lower(), r.json()['did']
+        except Exception as e:
+            logger.debug(f"Could not resolve Bluesky handle {handle}: {e}")
+            return handle.lower(), None
+
+    resolved = await asyncio.gather(*(resolve(handle) for handle in handles))
+    return {handle: did for handle, did in resolved if did}
+
+async def upload_image(local_file_path, alt_text):
+    # Debug: log the current file path
+    logger.debug(f"Processing image file: {local_file_path}")
+
+    # Open the image file from its location
+    with open(local_file_path, 'rb') as img_file:
+        img_data = img_file.read()
+
+    upload = await xrpc_post('com.atproto.repo.uploadBlob', content=img_data, headers={'Content-Type': 'image/jpeg'})
+    logger.debug(f"Uploaded image: {upload['blob']}")
+    return {'$type': 'app.bsky.embed.images#image', 'alt': alt_text or '', 'image': upload['blob']}
+
+async def read_chunks(local_file_path):
+    with open(local_file_path, 'rb') as video_file:
+        while chunk := await asyncio.to_thread(video_file.read, media.CHUNK_SIZE):
+            yield chunk
 
-def post_to_bluesky(text, image_locations, alt_texts):
+async def upload_video(local_file_path, alt_text):
+    # The video blob is streamed from disk; the AppView transcodes it for playback after the post is created
+    logger.debug(f"Processing video file: {local_file_path}")
+    upload = await xrpc_post('com.atproto.repo.uploadBlob', content_stream=lambda: read_chunks(local_file_path),
+                             headers={'Content-Type': 'video/mp4', 'Content-Length': str(os.path.getsize(local_file_path))})
+    logger.debug(f"Uploaded video: {upload['blob']}")
+    return {'$type': 'app.bsky.embed.video', 'alt': alt_text or '', 'video': upload['blob']}
+
+async def post_to_bluesky(text, image_locations, alt_texts):
+    state = await prepare_post(text, image_locations, alt_texts)
+    return state is not None and await publish_post(state)
+
+async def prepare_post(text, image_locations, alt_texts):
+    # Upload the blobs and resolve mentions ahead of time; the returned state is all publish_post needs
     try:
-        login_to_bluesky()
+        session or await login_to_bluesky()
     except Exception as e:
         logger.error(f"Failed to log in to Bluesky: {e}")
-        return False
+        return None
 
-    text = helpers.strip_html_tags(text)
-    logger.debug(f"Stripped text: {text}")
-    
-    images = []
-    for idx, image_location in enumerate(image_locations):
-        try:
+    local_file_path = None
+    try:
+        uploads = []
+        for idx, image_location in enumerate(image_locations):
             # Parse the URL and get the path
             url_parts = urlparse(image_location)
             local_file_path = url_parts.path[1:]  # Remove the leading '/'
+            upload = upload_video if media.is_video(local_file_path) else upload_image
+            uploads.append(aio.bounded('bluesky', aio.MAX_CONCURRENT_UPLOADS, upload(local_file_path, alt_texts[idx])))
+        images = await asyncio.gather(*uploads)
+    except Exception as e:
+        # Exception handling: log the error and local file path
+        logger.exception(f"Unable to process the image file at {local_file_path} for Bluesky. Error: {e}")
+        return None
 
-            # Debug: log the current file path
-            logger.debug(f"Processing image file: {local_file_path}")
+    tokens = richtext.scan(text)
+    links = [token.value for token in tokens if token.kind == 'link']
+    # Mentions and the link card of a text-only post are looked up at the same time
+    dids, external = await asyncio.gather(
+        resolve_handles({token.value for token in tokens if token.kind == 'mention'}),
+        link_card_embed(links[0]) if links and not images else asyncio.sleep(0),
+    )
+    # A post embeds either up to four images, one video or one link card
+    videos = [image for image in images if image['$type'] == 'app.bsky.embed.video']
+    return {'text': text, 'images': [image for image in images if image not in videos],
+            'video': videos[0] if videos else None, 'external': external,
+            'facets': richtext.bluesky_facets(tokens, dids)}
 
-            # Open the image file from its location
-            with open(local_file_path, 'rb') as img_file:
-                img_data = img_file.read()
+async def link_card_embed(url):
+    # app.bsky.embed.external for the first link; the thumbnail is uploaded once per image URL
+    card = await linkcards.get_card(url)
+    if card is None:
+        return None
+    external = {'uri': url, 'title': card['title'], 'description': card['description']}
+    if card['image']:
+        blob = thumb_blobs.get(card['image'])
+        if blob is None:
+            thumbnail = await linkcards.fetch_thumbnail(card['image'])
+            if thumbnail is not None:
+                try:
+                    upload = await xrpc_post('com.atproto.repo.uploadBlob', content=thumbnail[0],
+                                             headers={'Content-Type': thumbnail[1]})
+                    blob = upload['blob']
+                    thumb_blobs.set(card['image'], blob)
+                except Exception as e:
+                    logger.info(f"Link card thumbnail upload failed, posting the card without it: {e}")
+        if blob is not None:
+            external['thumb'] = blob
+    return {'$type': 'app.bsky.embed.external', 'external': external}
 
-            upload = client.com.atproto.repo.upload_blob(img_data)
-            images.append(models.AppBskyEmbedImages.Image(alt=alt_texts[idx], image=upload.blob))
-            logger.debug(f"Uploaded image: {upload.blob}")
-        except Exception as e:
-            # Exception handling: log the error and local file path
-            logger.exception(f"Unable to process the image file at {local_file_path} for Bluesky. Error: {e}")
-            return False
-
-    embed = models.AppBskyEmbedImages.Main(images=images) if images else None
-    facets = helpers.generate_facets_from_links_in_text(text) if helpers.URL_PATTERN.search(text) else None
-    logger.debug(f"Embed: {embed}, Facets: {facets}")
+async def publish_post(state):
+    # Returns the at:// URI and web URL of the new post, False on failure
+    record = {
+        '$type': 'app.bsky.feed.post',
+        'text': state['text'],
+        'createdAt': datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'),
+    }
+    if state.get('video'):
+        record['embed'] = state['video']
+    elif state['images']:
+        record['embed'] = {'$type': 'app.bsky.embed.images', 'images': state['images']}
+    elif state.get('external'):
+        record['embed'] = state['external']
+    if state['facets']:
+        record['facets'] = state['facets']
+    logger.debug("Embed: %s, Facets: %s", configLog.payload(record.get('embed')), configLog.payload(record.get('facets')))
 
     try:
-        client.com.atproto.repo.create_record(
-            models.ComAtprotoRepoCreateRecord.Data(
-                repo=client.me.did,
-                collection='app.bsky.feed.post',
-                record=models.AppBskyFeedPost.Main(
-                    createdAt=datetime.now().isoformat(), text=text, embed=embed, facets=facets
-                ),
-            )
-        )
+        current = session or await login_to_bluesky()
+        created = await xrpc_post('com.atproto.repo.createRecord', json={
+            'repo': current['did'],
+            'collection': 'app.bsky.feed.post',
+            'record': record,
+        })
         logger.debug("Bluesky post created.")
     except Exception as e:
         logger.exception(f"Failed to create Bluesky post: {e}")
         return False
 
+    rkey = created['uri'].rsplit('/', 1)[-1]
+    return {'remote_id': created['uri'], 'url': f"https://bsky.app/profile/{current['did']}/post/{rkey}"}
+
+async def delete_post(uri):
+    # uri is the at://<did>/app.bsky.feed.post/<rkey> returned by publish_post
+    repo, collection, rkey = uri[len('at://'):].split('/')
+    try:
+        await xrpc_post('com.atproto.repo.deleteRecord', json={'repo': repo, 'collection': collection, 'rkey': rkey})
+    except Exception as e:
+        logger.exception(f"Failed to delete Bluesky post {uri}: {e}")
+        return False
     return True
+
+async def probe():
+    return await aio.reachable(f'{PDS_URL}/xrpc/_health')
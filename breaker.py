@@ -0,0 +1,83 @@
+# breaker.py
+# A circuit breaker per platform. After FAILURE_THRESHOLD consecutive outages (a timeout,
+# connection error or 5xx answer, or a call without media slower than LATENCY_SLO) a platform's breaker opens: sends to it are skipped at once and go to the retry
+# path (see helpers.schedule_retry) instead of each waiting for the outage to time out.
+# While it is open, a background probe on the loop in aio.py checks the platform's health
+# and closes the breaker once the platform answers again. State is kept per process.
+import asyncio
+import threading
+import time
+
+import aio
+import configLog
+import platforms
+
+logger, speed_logger = configLog.configure_logging()
+
+CLOSED = 'closed'
+OPEN = 'open'
+
+FAILURE_THRESHOLD = 3
+LATENCY_SLO = 120.0      # seconds; a call without media uploads slower than this counts as an outage
+PROBE_INTERVAL = 30.0
+PROBE_TIMEOUT = 5.0
+RETRY_DELAY = 300        # seconds until deliveries skipped by an open breaker are tried again
+
+_lock = threading.Lock()
+_breakers = {}
+
+def configure(failure_threshold=None, latency_slo=None, retry_delay=None):
+    global FAILURE_THRESHOLD, LATENCY_SLO, RETRY_DELAY
+    FAILURE_THRESHOLD = failure_threshold or FAILURE_THRESHOLD
+    LATENCY_SLO = latency_slo or LATENCY_SLO
+    RETRY_DELAY = retry_delay or RETRY_DELAY
+
+def _breaker(platform):
+    return _breakers.setdefault(platform, {'state': CLOSED, 'failures': 0, 'opened_at': None, 'probe': None})
+
+def allow(platform):
+    with _lock:
+        return _breaker(platform)['state'] == CLOSED
+
+def record(platform, outage=None, seconds=None):
+    # Called on the shared loop after every call: outage describes what went wrong, None if the
+    # platform answered; seconds is only given for calls the latency SLO applies to
+    slow = seconds is not None and seconds > LATENCY_SLO
+    with _lock:
+        breaker = _breaker(platform)
+        if outage is None and not slow:
+            breaker['failures'] = 0
+            return
+        breaker['failures'] += 1
+        if breaker['state'] == OPEN or breaker['failures'] < FAILURE_THRESHOLD:
+            return
+        breaker.update(state=OPEN, opened_at=time.time())
+    reason = outage or f'took {seconds:.0f} s, over the {LATENCY_SLO:.0f} s SLO'
+    logger.warning(f'Circuit breaker for {platform} opened after {FAILURE_THRESHOLD} outages in a row, last: {reason}')
+    breaker['probe'] = asyncio.ensure_future(_probe_until_healthy(platform))
+
+def close(platform):
+    with _lock:
+        _breaker(platform).update(state=CLOSED, failures=0, opened_at=None, probe=None)
+    logger.warning(f'Circuit breaker for {platform} closed, the platform is healthy again')
+
+async def probe(platform):
+    try:
+        return bool(await asyncio.wait_for(platforms.get_function(platform, 'probe')(), PROBE_TIMEOUT))
+    except Exception as e:
+        logger.debug(f'Health probe of {platform} failed: {e}')
+        return False
+
+async def _probe_until_healthy(platform):
+    while True:
+        await asyncio.sleep(PROBE_INTERVAL)
+        aio.track_outages()  # the task inherited the list of the call that opened the breaker
+        if await probe(platform):
+            close(platform)
+            return
+
+def status():
+    with _lock:
+        return {platform: {'state': _breaker(platform)['state'], 'failures': _breaker(platform)['failures'],
+                           'opened_at': _breaker(platform)['opened_at']}
+                for platform in platforms.REGISTRY}
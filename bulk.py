@@ -0,0 +1,279 @@
+# bulk.py
+# Bulk scheduling of a whole content calendar from a JSON or CSV manifest.
+import io
+import os
+import csv
+import json
+import uuid
+import urllib.parse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pytz
+from PIL import Image
+from flask import url_for
+
+import helpers
+import render
+import validation
+import configLog
+from extensions import db
+from models import ScheduledPosts
+
+logger, speed_logger = configLog.configure_logging()
+
+MAX_MEDIA_PER_POST = validation.MAX_FILES
+MAX_POSTS_PER_MANIFEST = 5000
+
+class ManifestError(ValueError):
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} invalid manifest entries')
+        self.errors = errors
+
+def load_manifest(data, filename=''):
+    # Accept raw bytes/str of either a JSON list (or {"posts": [...]}) or a CSV with a header row
+    if isinstance(data, bytes):
+        data = data.decode('utf-8-sig')
+
+    if filename.lower().endswith('.csv') or not data.lstrip().startswith(('[', '{')):
+        return [_entry_from_csv_row(row) for row in csv.DictReader(io.StringIO(data))]
+
+    manifest = json.loads(data)
+    if isinstance(manifest, dict):
+        manifest = manifest.get('posts', [])
+    return manifest
+
+def _entry_from_csv_row(row):
+    # CSV columns mirror the form: media_1..media_4 with matching alt_text_1..alt_text_4
+    row = {key.strip(): (value or '').strip() for key, value in row.items() if key}
+    media = []
+    for i in range(1, MAX_MEDIA_PER_POST + 2):  # one past the limit so validation can reject it
+        path = row.get(f'media_{i}')
+        if path:
+            media.append({'path': path, 'alt_text': row.get(f'alt_text_{i}', '')})
+    return {
+        'text': row.get('text', ''),
+        'scheduled_time': row.get('scheduled_time', ''),
+        'timezone': row.get('timezone') or None,
+        'hashtags': row.get('hashtags') or None,
+        'platforms': row.get('platforms') or None,
+        'media': media,
+    }
+
+def _normalize_platforms(platforms):
+    if not platforms:
+        return list(helpers.PLATFORMS)
+    if isinstance(platforms, str):
+        platforms = platforms.replace(',', ' ').split()
+    return [platform.strip().lower() for platform in platforms]
+
+def _normalize_media(media):
+    normalized = []
+    for item in media or []:
+        if isinstance(item, str):
+            item = {'path': item}
+        normalized.append({'path': item.get('path', ''), 'alt_text': item.get('alt_text') or ''})
+    return normalized
+
+def _resolve_media_path(media_root, path):
+    full_path = os.path.realpath(os.path.join(media_root, path))
+    if os.path.commonpath([full_path, media_root]) != media_root:
+        raise ValueError(f"media path '{path}' is outside of the media root")
+    if not os.path.isfile(full_path):
+        raise ValueError(f"media file '{path}' does not exist")
+    return full_path
+
+def validate_manifest(entries, media_root, default_timezone=helpers.DEFAULT_TIMEZONE, truncate_overlong=False,
+                      require_alt_text=False):
+    # Validate every entry up front and return normalized posts; raise ManifestError listing all problems
+    if not isinstance(entries, list) or not entries:
+        raise ManifestError([{'index': None, 'error': 'manifest contains no posts'}])
+    if len(entries) > MAX_POSTS_PER_MANIFEST:
+        raise ManifestError([{'index': None, 'error': f'manifest exceeds {MAX_POSTS_PER_MANIFEST} posts'}])
+
+    media_root = os.path.realpath(media_root)
+    now = datetime.now(pytz.utc)
+    posts = []
+    errors = []
+
+    for index, entry in enumerate(entries):
+        entry_errors = []
+        if not isinstance(entry, dict):
+            errors.append({'index': index, 'error': 'entry is not an object'})
+            continue
+
+        text = (entry.get('text') or '').strip()
+        if not text:
+            entry_errors.append('text is required')
+
+        timezone = entry.get('timezone') or default_timezone
+        scheduled_time = None
+        if timezone not in pytz.all_timezones_set:
+            entry_errors.append(f"unknown timezone '{timezone}'")
+        elif not entry.get('scheduled_time'):
+            entry_errors.append('scheduled_time is required')
+        else:
+            try:
+                scheduled_time = helpers.parse_scheduled_time(entry['scheduled_time'], timezone)
+                if scheduled_time <= now:
+                    entry_errors.append(f"scheduled_time {entry['scheduled_time']} is in the past")
+            except ValueError as e:
+                entry_errors.append(str(e))
+
+        platforms = _normalize_platforms(entry.get('platforms'))
+        unknown = [platform for platform in platforms if platform not in helpers.PLATFORMS]
+        if unknown:
+            entry_errors.append(f"unknown platforms: {', '.join(unknown)}")
+        elif not platforms:
+            entry_errors.append('at least one platform must be enabled')
+
+        media = _normalize_media(entry.get('media'))
+        for item in media:
+            try:
+                item['full_path'] = _resolve_media_path(media_root, item['path'])
+            except ValueError as e:
+                entry_errors.append(str(e))
+
+        if entry_errors:
+            errors.extend({'index': index, 'error': error} for error in entry_errors)
+            continue
+
+        post = {
+            'index': index,
+            'text': text,
+            'scheduled_time': scheduled_time,
+            'timezone': timezone,
+            'hashtag_text': entry.get('hashtags'),
+            'platforms': platforms,
+            'media': media,
+        }
+        post['post_data'] = build_post_data(post)
+        render.prepare(post['post_data'], truncate_overlong)
+        post_errors = validation.validate_post(
+            post['post_data'],
+            [validation.inspect_image(item['full_path'], item['path']) for item in media],
+            require_alt_text,
+        )
+        if post_errors:
+            errors.extend({'index': index, 'error': error} for error in post_errors)
+            continue
+        posts.append(post)
+
+    if errors:
+        raise ManifestError(errors)
+    return posts
+
+def _convert_image(source_path, target_path):
+    # Returns an error message instead of raising, so a bad file is reported against its own post
+    try:
+        with Image.open(source_path) as image:
+            image.convert("RGB").save(target_path, 'JPEG', quality=90)
+    except Exception as e:  # corrupt files raise anything from OSError to SyntaxError in Pillow's decoders
+        return f'{os.path.basename(source_path)} could not be converted to JPEG: {e}'
+    return None
+
+def process_manifest_media(app, posts):
+    # Convert every image of every post in parallel; each post gets its own folder under static/temp
+    jobs = []
+    for post in posts:
+        folder_name = f'{post["scheduled_time"].strftime("%Y%m%d_%H%M%S")}_{uuid.uuid4().hex[:8]}'
+        post['folder_name'] = folder_name
+        os.makedirs(os.path.join(app.root_path, 'static/temp', folder_name), exist_ok=True)
+        for position, item in enumerate(post['media'], start=1):
+            filename = f'{position}.jpg'
+            item['filename'] = filename
+            jobs.append((post['index'], item['full_path'], os.path.join(app.root_path, 'static/temp', folder_name, filename)))
+
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = list(executor.map(lambda job: _convert_image(*job[1:]), jobs))
+    errors = [{'index': index, 'error': error} for (index, _, _), error in zip(jobs, results) if error]
+    if errors:
+        remove_media_folders(app, posts)
+        raise ManifestError(errors)
+    logger.info('Processed %d images for %d bulk posts', len(jobs), len(posts))
+
+    errors = []
+    for post in posts:
+        post['post_data']['image_locations'] = [
+            url_for('static', filename=f'temp/{post["folder_name"]}/{urllib.parse.quote(item["filename"])}', _external=True)
+            for item in post['media']
+        ]
+        # Byte sizes of the converted JPEGs that will be uploaded
+        paths = [os.path.join(app.root_path, 'static/temp', post['folder_name'], item['filename']) for item in post['media']]
+        errors.extend({'index': post['index'], 'error': error}
+                      for error in validation.validate_processed_media(post['post_data'], paths))
+    if errors:
+        remove_media_folders(app, posts)
+        raise ManifestError(errors)
+
+def build_post_data(post):
+    # Build the same post_data dictionary submit_form stores for a scheduled post
+    text, text_html, text_mastodon, subject = helpers.build_post_texts(
+        post['text'],
+        post['hashtag_text'],
+        bool(post['media'] and any(item['alt_text'] for item in post['media'])),
+        post['timezone'],
+    )
+    post_data = {
+        "text": text,
+        "text_html": text_html,
+        "text_mastodon": text_mastodon,
+        "hashtag": 'on' if post['hashtag_text'] else None,
+        "hashtag_text": post['hashtag_text'],
+        "subject": subject,
+        "processed_alt_texts": [item['alt_text'] for item in post['media']],
+        "image_locations": [],  # filled in once the images have been processed
+        "scheduled_time": post['scheduled_time'],
+        "textOnly": not post['media'],
+    }
+    for platform in helpers.PLATFORMS:
+        post_data[f'enable_{platform}'] = platform in post['platforms']
+    return post_data
+
+def remove_media_folders(app, posts):
+    for post in posts:
+        helpers.remove_temp_folder(os.path.join(app.root_path, 'static/temp', post['folder_name']))
+
+def schedule_posts(app, scheduler, posts, prestage_lead_seconds=0):
+    # Insert every ScheduledPosts row and its job in one unit: either all are scheduled or none are
+    rows = [
+        ScheduledPosts.from_post_data(post['post_data'], post['scheduled_time'].astimezone(pytz.utc))
+        for post in posts
+    ]
+    added_job_ids = []
+    try:
+        db.session.add_all(rows)
+        db.session.flush()  # assigns the ids used as job ids
+        for row in rows:
+            added_job_ids.extend(helpers.add_post_jobs(row.id, row.scheduled_time, prestage_lead_seconds))
+        db.session.commit()
+    except Exception as e:
+        logger.exception('Bulk scheduling failed, rolling back: %s', e)
+        db.session.rollback()
+        for job_id in added_job_ids:
+            try:
+                scheduler.remove_job(job_id)
+            except Exception:
+                logger.warning('Could not remove job %s during rollback', job_id)
+        remove_media_folders(app, posts)
+        raise
+
+    return [row.id for row in rows]
+
+def import_manifest(app, scheduler, data, filename=''):
+    start_time = datetime.now()
+    media_root = app.config.get('BULK_MEDIA_ROOT', app.root_path)
+    default_timezone = app.config.get('DEFAULT_TIMEZONE', helpers.DEFAULT_TIMEZONE)
+
+    try:
+        entries = load_manifest(data, filename)
+    except (ValueError, csv.Error) as e:
+        raise ManifestError([{'index': None, 'error': f'could not parse manifest: {e}'}])
+
+    posts = validate_manifest(entries, media_root, default_timezone, app.config.get('TRUNCATE_OVERLONG_POSTS', False),
+                              app.config.get('REQUIRE_ALT_TEXT', False))
+    process_manifest_media(app, posts)
+    post_ids = schedule_posts(app, scheduler, posts, app.config.get('PRESTAGE_LEAD_SECONDS', 600))
+
+    speed_logger.info(f"BULK import of {len(post_ids)} posts: {(datetime.now() - start_time).total_seconds()} seconds")
+    return post_ids
@@ -0,0 +1,53 @@
+# bulk_import.py
+# Command line client for the /bulk endpoint:
+#   python bulk_import.py calendar.csv --server https://yourdomain.com
+# The manifest is sent to the running app so its scheduler picks up the new jobs straight away.
+import os
+import sys
+import argparse
+import getpass
+
+import requests
+
+def main():
+    parser = argparse.ArgumentParser(description='Schedule every post of a JSON or CSV manifest in one go.')
+    parser.add_argument('manifest', help='path to the .json or .csv manifest')
+    parser.add_argument('--server', default='http://127.0.0.1:5000', help='base URL of the cross-poster')
+    parser.add_argument('--password', default=os.environ.get('CROSSPOST_PASSWORD'),
+                        help='login password (defaults to $CROSSPOST_PASSWORD, otherwise prompted)')
+    parser.add_argument('--token', default=os.environ.get('CROSSPOST_TOKEN'),
+                        help='API token from /api/token, used instead of the password (defaults to $CROSSPOST_TOKEN)')
+    args = parser.parse_args()
+
+    server = args.server.rstrip('/')
+
+    with requests.Session() as http:
+        if args.token:
+            http.headers['Authorization'] = f'Bearer {args.token}'
+        else:
+            password = args.password or getpass.getpass('Password: ')
+            r = http.post(f'{server}/login', data={'password': password}, allow_redirects=False)
+            if r.status_code != 302:
+                print('Login failed.', file=sys.stderr)
+                return 1
+
+        with open(args.manifest, 'rb') as manifest:
+            r = http.post(f'{server}/bulk', files={'manifest': (os.path.basename(args.manifest), manifest)})
+
+    if r.status_code != 200:
+        try:
+            errors = r.json().get('errors', [])
+        except ValueError:
+            print(f'Bulk import failed with status {r.status_code}: {r.text}', file=sys.stderr)
+            return 1
+        for error in errors:
+            where = f"entry {error['index']}" if error.get('index') is not None else 'manifest'
+            print(f"{where}: {error['error']}", file=sys.stderr)
+        return 1
+
+    result = r.json()
+    print(f"Scheduled {result['scheduled']} posts.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
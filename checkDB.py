@@ -1,20 +1,50 @@
-from app import app, ScheduledPosts
-
-def get_all_scheduled_posts():
-    with app.app_context():
-        scheduled_posts = ScheduledPosts.query.all()
-        return scheduled_posts
-
-all_posts = get_all_scheduled_posts()
-
-if len(all_posts) == 0:
-    print("No scheduled posts found in the database.")
-else:
-    print(f"Number of scheduled posts: {len(all_posts)}")
-    for post in all_posts:
-        print(f"Post ID: {post.id}")
-        print(f"Text: {post.text}")
-        print(f"Scheduled Time: {post.scheduled_time}")
-        print(f"Post Data: {post.post_data}")
-        print(f"Posted? {post.posted}")
+# checkDB.py
+# Prints the scheduled-posts queue. Uses a bare Flask app bound to the database only,
+# so it neither imports app.py nor starts the scheduler.
+import argparse
+
+from flask import Flask
+
+import dashboard
+from config import Config
+from extensions import db
+
+def create_db_app():
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    db.init_app(app)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description='Show scheduled posts.')
+    parser.add_argument('--platform', choices=dashboard.PLATFORMS)
+    parser.add_argument('--status')
+    parser.add_argument('--after', help='cursor printed at the end of the previous page')
+    parser.add_argument('--limit', type=int, default=dashboard.DEFAULT_PAGE_SIZE)
+    args = parser.parse_args()
+
+    with create_db_app().app_context():
+        counts = dashboard.queue_counts()
+        posts, next_cursor = dashboard.list_scheduled_posts(args.platform, args.status, args.after, args.limit)
+
+    if counts['total'] == 0:
+        print("No scheduled posts found in the database.")
+        return
+
+    print(f"Number of scheduled posts: {counts['total']}")
+    print(', '.join(f'{status}: {count}' for status, count in counts['by_status'].items()))
+    print(', '.join(f'{platform}: {count}' for platform, count in counts['by_platform'].items()))
+    print()
+    for post in posts:
+        print(f"Post ID: {post['id']}")
+        print(f"Text: {post['text']}")
+        print(f"Scheduled Time: {post['scheduled_time']}")
+        print(f"Platforms: {', '.join(post['platforms'])}")
+        print(f"Status: {post['status']}")
         print()
+
+    if next_cursor:
+        print(f"More posts: python checkDB.py --after '{next_cursor}'")
+
+if __name__ == "__main__":
+    main()
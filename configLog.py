@@ -1,7 +1,56 @@
+import atexit
 import logging
+import logging.config
+import logging.handlers
+import queue
+
+# Request bodies and API payloads are cut to this many characters when they are logged
+PAYLOAD_LIMIT = 500
+
+_loggers = None
+_listeners = []
 
 def configure_logging():
-    logging.config.fileConfig('logging.conf')
-    logger = logging.getLogger()
-    speed_logger = logging.getLogger('speed_logger')
-    return logger, speed_logger
\ No newline at end of file
+    # Every module calls this at import; logging.conf is only read the first time
+    global _loggers
+    if _loggers is None:
+        logging.config.fileConfig('logging.conf', disable_existing_loggers=False)
+        logger = logging.getLogger()
+        speed_logger = logging.getLogger('speed_logger')
+        for configured in (logger, speed_logger):
+            _move_handlers_to_queue(configured)
+        atexit.register(stop_logging)
+        _loggers = logger, speed_logger
+    return _loggers
+
+def _move_handlers_to_queue(logger):
+    # The file handlers run on a listener thread; the request and platform threads only enqueue records
+    handlers = logger.handlers[:]
+    if not handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+
+def stop_logging():
+    # Flush whatever is still queued, e.g. on interpreter exit
+    while _listeners:
+        _listeners.pop().stop()
+
+class payload:
+    # Lazy log argument: pass as logger.debug('... %s', configLog.payload(data)) so large
+    # payloads are only turned into (truncated) text when the record is actually emitted
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        text = self.value if isinstance(self.value, str) else repr(self.value)
+        if len(text) > PAYLOAD_LIMIT:
+            return f'{text[:PAYLOAD_LIMIT]}... ({len(text)} characters)'
+        return text
@@ -0,0 +1,74 @@
+# dashboard.py
+# Read-only queries for the scheduled-posts queue. Only plain columns are selected,
+# so post_data is never unpickled for rows that are just being listed.
+from datetime import datetime
+
+from sqlalchemy import and_, or_, func
+
+from extensions import db
+from models import ScheduledPosts, ScheduledPostPlatforms, PLATFORMS
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+TEXT_PREVIEW_LENGTH = 200
+
+def encode_cursor(scheduled_time, post_id):
+    return f'{scheduled_time.isoformat()},{post_id}'
+
+def decode_cursor(cursor):
+    scheduled_time, post_id = cursor.rsplit(',', 1)
+    return datetime.fromisoformat(scheduled_time), int(post_id)
+
+def list_scheduled_posts(platform=None, status=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    # Keyset pagination over (scheduled_time, id): every page is an index range scan, no OFFSET
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    query = db.session.query(
+        ScheduledPosts.id,
+        ScheduledPosts.scheduled_time,
+        ScheduledPosts.status,
+        func.substr(ScheduledPosts.text, 1, TEXT_PREVIEW_LENGTH).label('text'),
+    )
+    if platform:
+        query = query.join(ScheduledPostPlatforms).filter(ScheduledPostPlatforms.platform == platform)
+    if status:
+        query = query.filter(ScheduledPosts.status == status)
+    if after:
+        after_time, after_id = decode_cursor(after)
+        query = query.filter(or_(
+            ScheduledPosts.scheduled_time > after_time,
+            and_(ScheduledPosts.scheduled_time == after_time, ScheduledPosts.id > after_id),
+        ))
+
+    rows = query.order_by(ScheduledPosts.scheduled_time, ScheduledPosts.id).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Fetch the platforms of just this page in a single indexed query
+    platforms_by_post = {}
+    if rows:
+        for post_id, post_platform in db.session.query(ScheduledPostPlatforms.post_id, ScheduledPostPlatforms.platform) \
+                .filter(ScheduledPostPlatforms.post_id.in_([row.id for row in rows])):
+            platforms_by_post.setdefault(post_id, []).append(post_platform)
+
+    posts = [{
+        'id': row.id,
+        'scheduled_time': row.scheduled_time.isoformat(),
+        'status': row.status,
+        'text': row.text,
+        'platforms': sorted(platforms_by_post.get(row.id, []), key=PLATFORMS.index),
+    } for row in rows]
+
+    next_cursor = encode_cursor(rows[-1].scheduled_time, rows[-1].id) if has_more else None
+    return posts, next_cursor
+
+def queue_counts():
+    by_status = dict(db.session.query(ScheduledPosts.status, func.count(ScheduledPosts.id))
+                     .group_by(ScheduledPosts.status))
+    by_platform = dict(db.session.query(ScheduledPostPlatforms.platform, func.count(ScheduledPostPlatforms.post_id))
+                       .group_by(ScheduledPostPlatforms.platform))
+    return {
+        'total': sum(by_status.values()),
+        'by_status': by_status,
+        'by_platform': {platform: by_platform.get(platform, 0) for platform in PLATFORMS},
+    }
@@ -1,4 +1,8 @@
 # extensions.py
 from flask_sqlalchemy import SQLAlchemy
+from flask_apscheduler import APScheduler
+from flask_session import Session
 
 db = SQLAlchemy()
+scheduler = APScheduler()
+server_session = Session()
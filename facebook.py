@@ -1,18 +1,24 @@
-import requests
+import os
 import json
 import uuid
+import asyncio
+import aio
+import media
+import richtext
+from urllib.parse import urlparse
 from typing import List, Optional
 from config import (FB_ACCESS_TOKEN, FB_PAGE_ID)
-from concurrent.futures import ThreadPoolExecutor
 import configLog
 
 logger, speed_logger = configLog.configure_logging()
 
 # Constants for Facebook URLs
+GRAPH_URL = 'https://graph.facebook.com'
 IMAGE_URL = f'https://graph.facebook.com/{FB_PAGE_ID}/photos'
 FEED_URL = f"https://graph.facebook.com/{FB_PAGE_ID}/feed"
+VIDEO_URL = f"https://graph-video.facebook.com/{FB_PAGE_ID}/videos"
 
-def upload_image_to_fb(image_location: str) -> Optional[str]:
+async def upload_image_to_fb(image_location: str) -> Optional[str]:
     payload = {
         'url': image_location,
         'access_token': FB_ACCESS_TOKEN,
@@ -21,7 +27,11 @@ def upload_image_to_fb(image_location: str) -> Optional[str]:
     # Generate a unique id for this operation
     operation_id = uuid.uuid4()
     logger.debug(f"{operation_id} - Initiating upload for image: {image_location}")
-    r = requests.post(IMAGE_URL, data=payload)
+    try:
+        r = await aio.get_client().post(IMAGE_URL, data=payload)
+    except Exception as e:
+        logger.error(f"{operation_id} - Failed to upload image: {image_location}. Error: {e}")
+        return None
     if r.status_code != 200:
         logger.error(f"{operation_id} - Failed to upload image: {image_location}. Error: {r.text}")
         return None
@@ -30,27 +40,115 @@ def upload_image_to_fb(image_location: str) -> Optional[str]:
     logger.debug(f"{operation_id} - uploaded photo id: {photo_id}")
     return photo_id
 
-def upload_images_to_fb(image_locations: List[str]) -> List[str]:
-    with ThreadPoolExecutor() as executor:
-        futures = {executor.submit(upload_image_to_fb, image_location) for image_location in image_locations}
-        uploaded_photo_ids = [future.result() for future in futures if future.result() is not None]
-    return uploaded_photo_ids
-
-def post_to_facebook(image_locations: List[str], text: str, alt_texts: Optional[List[str]] = None) -> bool:
-    if alt_texts:
-        alt_text_str = "\n\n".join(filter(None, alt_texts))  # Filter out empty alt texts and join them with line breaks
-        text = text.replace("[prompt in the alt]", "[image prompts below]") + "\n\n" + alt_text_str
-    uploaded_photo_ids = upload_images_to_fb(image_locations)
+async def upload_images_to_fb(image_locations: List[str]) -> List[str]:
+    photo_ids = await asyncio.gather(*(
+        aio.bounded('facebook', aio.MAX_CONCURRENT_UPLOADS, upload_image_to_fb(image_location))
+        for image_location in image_locations
+    ))
+    return [photo_id for photo_id in photo_ids if photo_id is not None]
+
+async def post_to_facebook(image_locations: List[str], text: str):
+    state = await prepare_post(image_locations, text)
+    return state is not None and await publish_post(state)
+
+async def prepare_post(image_locations: List[str], text: str) -> Optional[dict]:
+    # Upload the photos unpublished ahead of time; text already carries the alt texts, see render.py.
+    # A video is a post of its own; its upload is left open and only finished by publish_post.
+    videos = [location for location in image_locations if media.is_video(location)]
+    if videos:
+        video = await upload_video_to_fb(urlparse(videos[0]).path[1:])
+        if video is None:
+            return None
+        return dict(video, text=text, photo_ids=[])
+    uploaded_photo_ids = await upload_images_to_fb(image_locations)
+    links = richtext.find_urls(text)
+    return {'text': text, 'photo_ids': uploaded_photo_ids, 'link': links[0] if links else None}
+
+async def upload_video_to_fb(local_file_path: str) -> Optional[dict]:
+    # Resumable upload: start, then transfer the chunks Facebook asks for, read from disk one at a time
+    try:
+        r = await aio.get_client().post(VIDEO_URL, data={'access_token': FB_ACCESS_TOKEN, 'upload_phase': 'start',
+                                                         'file_size': os.path.getsize(local_file_path)})
+        r.raise_for_status()
+        upload = r.json()
+        upload_session_id = upload['upload_session_id']
+        start_offset, end_offset = int(upload['start_offset']), int(upload['end_offset'])
+
+        with open(local_file_path, 'rb') as video:
+            while start_offset < end_offset:
+                video.seek(start_offset)
+                chunk = await asyncio.to_thread(video.read, end_offset - start_offset)
+                r = await aio.get_client().post(VIDEO_URL, data={
+                    'access_token': FB_ACCESS_TOKEN, 'upload_phase': 'transfer',
+                    'upload_session_id': upload_session_id, 'start_offset': start_offset,
+                }, files={'video_file_chunk': chunk})
+                r.raise_for_status()
+                start_offset, end_offset = int(r.json()['start_offset']), int(r.json()['end_offset'])
+    except Exception as e:
+        logger.error(f"Failed to upload video: {local_file_path}. Error: {e}")
+        return None
+    return {'upload_session_id': upload_session_id, 'video_id': upload['video_id']}
+
+async def publish_video(state: dict):
+    try:
+        r = await aio.get_client().post(VIDEO_URL, data={
+            'access_token': FB_ACCESS_TOKEN, 'upload_phase': 'finish',
+            'upload_session_id': state['upload_session_id'], 'description': state['text'],
+        })
+        r.raise_for_status()
+    except Exception as e:
+        logger.error(f"Failed to publish video. Error: {e}")
+        return False
+    video_id = state['video_id']
+    logger.info("Video published successfully!")
+    return {'remote_id': video_id, 'url': f'https://www.facebook.com/{video_id}'}
+
+async def publish_post(state: dict):
+    # Returns the id and URL of the new post, False on failure
+    if state.get('upload_session_id'):
+        return await publish_video(state)
     payload = {
         'access_token': FB_ACCESS_TOKEN,
-        'message': text,  # Assuming the function helpers.strip_html_tags() was removed for a reason
+        'message': state['text'],
     }
-    if uploaded_photo_ids:
-        attached_media = [{"media_fbid": photo_id} for photo_id in uploaded_photo_ids]
+    if not state['photo_ids'] and state.get('link'):
+        payload['link'] = state['link']  # Facebook scrapes the Open Graph card of a text-only post's first link
+    if state['photo_ids']:
+        attached_media = [{"media_fbid": photo_id} for photo_id in state['photo_ids']]
         payload['attached_media'] = json.dumps(attached_media)
-    r = requests.post(FEED_URL, data=payload)
+    try:
+        r = await aio.get_client().post(FEED_URL, data=payload)
+    except Exception as e:
+        logger.error(f"Failed to publish post. Error: {e}")
+        return False
     if r.status_code != 200:
         logger.error(f"Failed to publish post. Error: {r.text}")
         return False
+    post_id = r.json()['id']
     logger.info("Post published successfully!")
+    return {'remote_id': post_id, 'url': f'https://www.facebook.com/{post_id}'}
+
+async def delete_post(post_id: str) -> bool:
+    try:
+        r = await aio.get_client().delete(f'{GRAPH_URL}/{post_id}', params={'access_token': FB_ACCESS_TOKEN})
+    except Exception as e:
+        logger.error(f"Failed to delete post {post_id}. Error: {e}")
+        return False
+    if r.status_code != 200:
+        logger.error(f"Failed to delete post {post_id}. Error: {r.text}")
+        return False
+    return True
+
+async def edit_post(post_id: str, text: str) -> bool:
+    try:
+        r = await aio.get_client().post(f'{GRAPH_URL}/{post_id}', data={'access_token': FB_ACCESS_TOKEN, 'message': text})
+    except Exception as e:
+        logger.error(f"Failed to edit post {post_id}. Error: {e}")
+        return False
+    if r.status_code != 200:
+        logger.error(f"Failed to edit post {post_id}. Error: {r.text}")
+        return False
     return True
+
+async def probe():
+    return await aio.reachable(GRAPH_URL)
@@ -0,0 +1,18 @@
+# gunicorn.conf.py
+# The deployment configuration; gunicorn reads it from the working directory:  gunicorn wsgi:app
+# One worker with many threads by default, so the admission limits in admission.py, the
+# scheduler and in-memory sessions all cover the whole app. Threaded workers are only timed
+# out when their main loop hangs, not when a request (e.g. a big upload) takes long.
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+# More threads than admission slots plus queue, so a burst is answered with 429/503 by the
+# app instead of piling up unseen in the socket backlog
+threads = int(os.environ.get('GUNICORN_THREADS', 64))
+timeout = 30
+graceful_timeout = 30
+
+# admission.py divides the CPU cores between the workers
+os.environ['WEB_CONCURRENCY'] = str(workers)
@@ -4,30 +4,35 @@ import io
 import os
 import uuid
 import time
+import asyncio
 import shutil
 import logging.config
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Third-party imports
 from PIL import Image
 import pytz
-from flask import url_for, flash
+from flask import url_for, flash, has_request_context
 import urllib.parse
 
 # Local application/library specific imports
-import posthaven
-import bluesky
-import instagram
-import masto
-import twitter
-import facebook
+import aio
+import media
+import render
+import richtext
 import configLog
-from extensions import db
-from models import ScheduledPosts
+import platforms
+import history
+import breaker
+import validation
+from extensions import db, scheduler
+from models import ScheduledPosts, PLATFORMS, new_post_key, STATUS_SCHEDULED, STATUS_STAGING, STATUS_STAGED, STATUS_SENDING, STATUS_FAILED
 
-from app import flask_app
+URL_PATTERN = richtext.URL_PATTERN
 
-URL_PATTERN = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+MAX_RETRIES = 5  # retries of deliveries skipped by an open circuit breaker
+DEFAULT_TIMEZONE = 'Europe/Berlin'
+SCHEDULED_TIME_FORMATS = ('%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S')
 
 # At the top level of helpers.py
 logger, speed_logger = configLog.configure_logging()
@@ -50,31 +55,11 @@ def resize_image(image_file, max_size_kb=976.56, max_iterations=10):
 
 # URL and HTML processing
 def generate_facets_from_links_in_text(text):
-    return [gen_link(*match.span(), match.group(0)) for match in URL_PATTERN.finditer(text)]
-
-def gen_link(start, end, uri):
-    return gen_range(start, end, [{
-        "$type": "app.bsky.richtext.facet#link",
-        "uri": uri
-    }])
-
-def gen_range(start, end, features):
-    return {
-        "index": {
-            "byteStart": start,
-            "byteEnd": end
-        },
-        "features": features
-    }
+    # Link and hashtag facets; mentions need their DIDs resolved first, see bluesky.py
+    return richtext.bluesky_facets(richtext.scan(text, mentions=False))
 
 def urls_to_html_links(text_html):
-    url_format = '<a href="{}">{}</a>'
-    url_matches = list(URL_PATTERN.finditer(text_html))
-    for match in reversed(url_matches):
-        url = match.group(0)
-        start, end = match.span()
-        text_html = text_html[:start] + url_format.format(url, url) + text_html[end:]
-    return text_html
+    return richtext.html_links(text_html)
 
 # Logging
 def configure_logging():
@@ -108,11 +93,50 @@ def try_posting(platform, action, post_data, message_format, *args):
     speed_logger.info(f"{platform} post execution time: {elapsed_time} seconds")
     post_data['success_messages'].append(platform)
 
-def send_to_platform(platform, send_func, *args):
-    elapsed_time, result = timed_execution(send_func, *args)
-    speed_logger.info(f"{platform} upload execution time: {elapsed_time} seconds")
-    logger.debug(f'Posting to {platform} completed')
-    return bool(result)
+async def call_platform(platform, func, *args, action='upload', timed=True, outages_out=None):
+    start = time.time()
+    outages = aio.track_outages()
+    try:
+        result = await func(*args)
+    except Exception as e:
+        logger.exception(f'Unexpected error while posting to {platform}: {e}')
+        result = None
+    elapsed = time.time() - start
+    # Only failures with a timeout, connection error or 5xx answer count against the circuit breaker,
+    # a rejected post says nothing about the platform's health; latency only counts for timed calls
+    outage = outages[-1] if outages and not result else None
+    breaker.record(platform, outage, elapsed if timed else None)
+    if outage and outages_out is not None:
+        outages_out[platform] = outage
+    speed_logger.info(f"{platforms.display_name(platform)} {action} execution time: {elapsed} seconds")
+    logger.debug(f'{action.capitalize()} for {platform} completed')
+    return result, elapsed
+
+async def publish_staged(platform, state, args):
+    # Staged ids can expire (e.g. after a long outage); fall back to a full send then. Only when
+    # the platform refused the publish with a 4xx answer: after a timeout, a 5xx or an answer that
+    # could not be read the post may already be out, and a full send could publish it twice.
+    seen = len(aio.answers())
+    result = await platforms.get_function(platform, 'publish')(state)
+    if result:
+        return result
+    answers = aio.answers()[seen:]
+    if not answers or not 400 <= answers[-1] < 500:
+        logger.error(f'Publishing the pre-staged {platform} post failed without a clear refusal, not sending it again')
+        return result
+    logger.warning(f'The platform refused the pre-staged {platform} post (HTTP {answers[-1]}), sending it in full instead')
+    return await platforms.get_sender(platform)(*args)
+
+async def call_platforms(calls, action, timed=True, outages=None):
+    # Fan out to every platform at once on the shared event loop; returns {platform: (result, seconds)}.
+    # timed=False for calls that upload media, whose duration depends on the media, not the platform;
+    # outages, if given, receives {platform: reason} for the calls that failed with an outage
+    async with aio.semaphore('posts', aio.MAX_CONCURRENT_POSTS):
+        results = await asyncio.gather(*(
+            call_platform(platform, func, *args, action=action, timed=timed, outages_out=outages)
+            for platform, (func, args) in calls.items()
+        ))
+    return dict(zip(calls, results))
 
 def log_and_flash_messages(post_data, success_messages, error_messages):
     success_message = ''
@@ -123,7 +147,8 @@ def log_and_flash_messages(post_data, success_messages, error_messages):
     if error_messages:
         error_message = f'Failed to post to: {", ".join(error_messages)}.'
 
-    if post_data.get('scheduled_time'):
+    # Scheduled posts and posts sent by a job after transcoding have no one to flash to
+    if post_data.get('scheduled_time') or not has_request_context():
         if success_message and error_message:
             logger.debug(f'{success_message} {error_message}')
         elif success_message:
@@ -138,30 +163,90 @@ def log_and_flash_messages(post_data, success_messages, error_messages):
         elif error_message:
             flash(error_message)
 
-def send_post(post_data):
-    platforms_to_funcs = {
-        'Twitter': (twitter.upload_to_twitter, [post_data['image_locations'], post_data['processed_alt_texts'], post_data['text_mastodon']]),
-        'Mastodon': (masto.post_to_mastodon, [post_data['subject'], post_data['text_mastodon'], post_data['image_locations'], post_data['processed_alt_texts']]),
-        'Bluesky': (bluesky.post_to_bluesky, [post_data['text_mastodon'], post_data['image_locations'], post_data['processed_alt_texts']]),
-        'Posthaven': (posthaven.send_email_with_attachments, [post_data['subject'], post_data['text'], post_data['image_locations'], post_data['processed_alt_texts']]),
-        'Facebook': (facebook.post_to_facebook, [post_data['image_locations'], post_data['text_mastodon'], post_data['processed_alt_texts']]),
-        'Instagram': (instagram.postInstagramCarousel, [post_data['image_locations'], post_data['text']]),
+def platform_send_args(post_data):
+    rendered = render.get_rendered(post_data)
+    # Every platform gets its own variant of a video, see media.py
+    locations = {platform: media.locations_for(post_data, platform) for platform in PLATFORMS}
+    return {
+        'twitter': [locations['twitter'], post_data['processed_alt_texts'], rendered['twitter']],
+        'mastodon': [post_data['subject'], rendered['mastodon'], locations['mastodon'], post_data['processed_alt_texts']],
+        'bluesky': [rendered['bluesky'], locations['bluesky'], post_data['processed_alt_texts']],
+        'posthaven': [post_data['subject'], rendered['posthaven'], locations['posthaven'], post_data['processed_alt_texts']],
+        'facebook': [locations['facebook'], rendered['facebook']],
+        'instagram': [locations['instagram'], rendered['instagram']],
     }
 
-    success_messages = []
-    error_messages = []
+def enabled_platforms(post_data):
+    return [platform for platform in platforms.REGISTRY if post_data[f'enable_{platform}']]
+
+def send_post(post_data):
+    # Platform modules are imported here, in the calling thread, so the event loop never blocks on an import.
+    # Platforms that were pre-staged only need their publish call. Returns the platforms that were
+    # skipped because their circuit breaker is open or that ran into an outage; see schedule_retry.
+    platform_args = platform_send_args(post_data)
+    staged = post_data.get('staged') or {}
+    post_key = post_data.setdefault('post_key', new_post_key())
+    # A retry of a post only goes to the platforms it has not been published on yet
+    already_published = history.published(post_key)
+    calls = {}
+    deferred = []
+    for platform in enabled_platforms(post_data):
+        if platform in already_published:
+            logger.info(f'Post {post_key} is already on {platform} ({already_published[platform].remote_id}), not sending it again')
+            continue
+        if not breaker.allow(platform):
+            logger.warning(f'{platform} is unavailable (circuit breaker open), post {post_key} will be retried')
+            deferred.append(platform)
+            continue
+        platforms.load_module(platform)
+        if staged.get(platform) is not None:
+            calls[platform] = (publish_staged, [platform, staged[platform], platform_args[platform]])
+        else:
+            calls[platform] = (platforms.get_sender(platform), platform_args[platform])
+    outages = {}
+    results = aio.run(call_platforms(calls, 'upload', timed=not post_data['image_locations'], outages=outages))
+    # Deliveries that ran into a timeout, connection error or 5xx go to the retry path as well
+    for platform, reason in outages.items():
+        logger.warning(f'{platform} had an outage ({reason}), post {post_key} will be retried')
+        deferred.append(platform)
+
+    rendered = render.get_rendered(post_data)
+    sizes = {platform: history.payload_bytes(rendered[platform], media.locations_for(post_data, platform)) for platform in results}
+    hashtag_text = post_data.get('hashtag_text') if post_data.get('hashtag') == 'on' else None
+    history.record_results(post_key, results, sizes, hashtag_text, post_data['processed_alt_texts'])
+
+    success_messages = [platforms.display_name(platform) for platform in already_published]
+    success_messages += [platforms.display_name(platform) for platform, (result, _) in results.items() if result]
+    error_messages = [platforms.display_name(platform) for platform, (result, _) in results.items()
+                      if not result and platform not in outages]
 
-    for platform, (send_func, args) in platforms_to_funcs.items():
-        if post_data[f'enable_{platform.lower()}']:
-            result = send_to_platform(platform, send_func, *args)
-            if result:
-                success_messages.append(platform)
-            else:
-                error_messages.append(platform)
-    
     log_and_flash_messages(post_data, success_messages, error_messages)
-    
-    # New code to delete the temporary folder after posting images
+    if not deferred:
+        remove_post_images(post_data)  # otherwise the retry still needs them
+    return deferred
+
+def schedule_retry(post_data, deferred):
+    # Schedule the platforms an open circuit breaker or an outage kept the post from as a new post; the post_key is kept,
+    # so post_history makes sure nothing is published twice. Returns the retry time or None.
+    retries = post_data.get('retries', 0) + 1
+    if retries > MAX_RETRIES:
+        logger.error(f"Giving up on post {post_data.get('post_key')} for {', '.join(deferred)} after {MAX_RETRIES} retries")
+        remove_post_images(post_data)
+        return None
+
+    run_date = datetime.now(pytz.utc) + timedelta(seconds=breaker.RETRY_DELAY)
+    retry_data = dict(post_data, retries=retries, scheduled_time=run_date)
+    retry_data.update({f'enable_{platform}': platform in deferred for platform in PLATFORMS})
+    retry_data.pop('processed_files', None)
+    post = ScheduledPosts.from_post_data(retry_data, run_date)
+    db.session.add(post)
+    db.session.commit()
+    add_post_jobs(post.id, run_date)
+    logger.info(f"Post {post_data.get('post_key')} will be retried on {', '.join(deferred)} at {run_date.isoformat()}")
+    return run_date
+
+def remove_post_images(post_data):
+    # Delete the temporary folder of the post's images
     for image_location in post_data['image_locations']:
         # Parse the URL to get the path
         url_path = urllib.parse.urlparse(image_location).path
@@ -170,11 +255,145 @@ def send_post(post_data):
             url_path = url_path[1:]
         # Join the path to get the absolute path of the local directory
         dir_path = os.path.join(os.getcwd(), url_path)
-        # Get the parent directory of the image file
-        parent_dir = os.path.dirname(dir_path)
-        # Remove the directory
-        if os.path.exists(parent_dir) and os.path.isdir(parent_dir):
-            shutil.rmtree(parent_dir)
+        # Remove the parent directory of the image file
+        remove_temp_folder(os.path.dirname(dir_path))
+
+def remove_temp_folder(parent_dir):
+    if os.path.exists(parent_dir) and os.path.isdir(parent_dir):
+        shutil.rmtree(parent_dir)
+
+def parse_scheduled_time(value, timezone=DEFAULT_TIMEZONE):
+    # Parse a naive 'datetime-local' style string and localize it to the given timezone
+    tz = pytz.timezone(timezone)
+    for fmt in SCHEDULED_TIME_FORMATS:
+        try:
+            return tz.localize(datetime.strptime(value, fmt))
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised scheduled time '{value}'")
+
+def build_post_texts(text, hashtag_text=None, has_alt_text=False, timezone=DEFAULT_TIMEZONE):
+    # Build the per-format texts that submit_form used to assemble inline
+    text_html = "<br>".join(text.splitlines())  # Convert line breaks to <br> tags
+    text_html = urls_to_html_links(text_html)  # Convert URLs to links
+
+    if has_alt_text:
+        text += '\n\n[prompt in the alt]'
+
+    if hashtag_text:
+        text += '\n\n' + hashtag_text
+
+    text_mastodon = "\n".join(text.splitlines())  # Convert line breaks to \n for Mastodon
+
+    text = f'<big>{text_html}</big><hr>'
+
+    # Create the email subject from the first 10 characters of the 'text' field
+    now = datetime.now(pytz.timezone(timezone))
+    text_preview = strip_html_tags(text[:10])
+    subject = f'[{now.strftime("%Y/%m/%d")}] {text_preview} ...'
+
+    return text, text_html, text_mastodon, subject
+
+def change_post(post_key, action, text=None, truncate_overlong=False):
+    # Delete or edit every published copy of a post at once. Returns ({platform: 'done' | 'failed' | 'unavailable' |
+    # 'unsupported'}, errors); errors are the length errors of an edit, nothing is changed then.
+    published = history.published(post_key)
+    supported = [platform for platform in published if platforms.supports(platform, action)]
+    outcome = {platform: 'unsupported' for platform in published if platform not in supported}
+    outcome.update({platform: 'unavailable' for platform in supported if not breaker.allow(platform)})
+    supported = [platform for platform in supported if platform not in outcome]
+
+    args = {platform: [published[platform].remote_id] for platform in supported}
+    if action == 'edit' and supported:
+        # Render the new text for each platform the same way the post was rendered, with the hashtag
+        # block, the alt text marker and Facebook's alt texts it was published with
+        original = published[supported[0]]
+        alt_texts = original.alt_texts or []
+        post_text, _, text_mastodon, _ = build_post_texts(text, original.hashtag_text, any(alt_texts))
+        post_data = {'text': post_text, 'text_mastodon': text_mastodon, 'processed_alt_texts': alt_texts}
+        post_data.update({f'enable_{platform}': platform in supported for platform in PLATFORMS})
+        errors = render.prepare(post_data, truncate_overlong)
+        if errors:
+            return outcome, errors
+        for platform in supported:
+            args[platform].append(post_data['rendered'][platform])
+        if 'mastodon' in supported:
+            # An edit that leaves out the attachments removes them, see masto.edit_status
+            args['mastodon'] += [published['mastodon'].media_ids or [], alt_texts]
+
+    calls = {platform: (platforms.get_function(platform, action), args[platform]) for platform in supported}
+    results = aio.run(call_platforms(calls, action))
+    outcome.update({platform: 'done' if result else 'failed' for platform, (result, _) in results.items()})
+
+    if action == 'delete':
+        history.mark_deleted(post_key, [platform for platform, result in outcome.items() if result == 'done'])
+    logger.info(f'{action.capitalize()} of post {post_key}: {outcome}')
+    return outcome, []
+
+def prestage_post(post_data):
+    # Run every enabled platform's prepare step now and return the states that succeeded
+    platform_args = platform_send_args(post_data)
+    calls = {platform: (platforms.get_function(platform, 'prepare'), platform_args[platform])
+             for platform in enabled_platforms(post_data) if breaker.allow(platform)}
+    states = aio.run(call_platforms(calls, 'pre-stage', timed=False))
+    return {platform: state for platform, (state, _) in states.items() if state is not None}
+
+def add_post_jobs(post_id, run_date, prestage_lead_seconds=0):
+    # Schedule the send at run_date (UTC) and, if there is time for it, the pre-stage ahead of it
+    job_ids = [str(post_id)]
+    scheduler.add_job(id=job_ids[0], func='helpers:send_scheduled_post', args=[post_id], trigger='date', run_date=run_date)
+    if prestage_lead_seconds:
+        prestage_time = run_date - timedelta(seconds=prestage_lead_seconds)
+        if prestage_time > datetime.now(pytz.utc):
+            job_ids.append(f'{post_id}_prestage')
+            scheduler.add_job(id=job_ids[1], func='helpers:prestage_scheduled_post', args=[post_id], trigger='date',
+                              run_date=prestage_time)
+    return job_ids
+
+def queue_transcode(post_data, videos, prestage_lead_seconds=0):
+    # videos: (source path, folder, basename) of each saved upload. Transcoding can take minutes,
+    # longer than a request may, so it runs as a scheduler job; see transcode_post
+    post_key = post_data.setdefault('post_key', new_post_key())
+    post_data.pop('processed_files', None)  # the job only needs the paths in image_locations
+    scheduler.add_job(id=f'{post_key}_transcode', func='helpers:transcode_post', trigger='date',
+                      run_date=datetime.now(pytz.utc), args=[post_data, videos, prestage_lead_seconds])
+    logger.info(f"Post {post_key} will be sent once {len(videos)} video(s) are transcoded")
+
+def transcode_post(post_data, videos, prestage_lead_seconds=0):
+    # Make every video's variants, then send the post or put it in the queue; a post whose
+    # videos fail is recorded as failed on all its platforms in post_history
+    with scheduler.app.app_context():
+        post_key = post_data['post_key']
+        platforms_enabled = enabled_platforms(post_data)
+        try:
+            paths = []
+            for source_path, folder, basename in videos:
+                try:
+                    paths.append(media.transcode_variants(source_path, folder, basename, platforms_enabled)[0])
+                finally:
+                    os.remove(source_path)
+            errors = validation.validate_processed_media(post_data, paths)
+        except media.MediaError as e:
+            errors = [str(e)]
+        if errors:
+            logger.error(f"Post {post_key} was not sent: {' '.join(errors)}")
+            history.record_results(post_key, {platform: (None, 0) for platform in platforms_enabled}, {})
+            remove_post_images(post_data)
+            return
+
+        scheduled_time = post_data.get('scheduled_time')
+        if scheduled_time:
+            # A transcode that outlasted the scheduled time sends the post right away
+            run_date = max(scheduled_time.astimezone(pytz.utc), datetime.now(pytz.utc))
+            post = ScheduledPosts.from_post_data(post_data, run_date)
+            db.session.add(post)
+            db.session.commit()
+            add_post_jobs(post.id, run_date, prestage_lead_seconds)
+            logger.info(f"Post {post_key} is transcoded and scheduled for {run_date.isoformat()}")
+        else:
+            deferred = send_post(post_data)
+            if deferred:
+                schedule_retry(post_data, deferred)
 
 def create_subject(text):
     now = datetime.now()
@@ -203,7 +422,7 @@ def save_post_to_database(post_data):
         # Remove processed_files from the post_data
         post_data.pop('processed_files', None)
 
-        post = ScheduledPosts(text=post_data.get('text'), scheduled_time=utc_scheduled_time, post_data=post_data)
+        post = ScheduledPosts.from_post_data(post_data, utc_scheduled_time)
         try:
             with db.session.begin():
                 db.session.add(post)
@@ -222,7 +441,7 @@ def save_post_to_database(post_data):
 def send_scheduled_post(post_id):
     logger.debug('send_scheduled_post function triggered')
 
-    with flask_app.app_context():
+    with scheduler.app.app_context():
         post = ScheduledPosts.query.get(post_id)
 
         if not post or post.posted:
@@ -233,14 +452,27 @@ def send_scheduled_post(post_id):
         scheduled_time = scheduled_time.astimezone(pytz.utc)
 
         if scheduled_time <= current_time:
+            # Claim the post atomically so that only one worker ever sends it
+            claimed = ScheduledPosts.query.filter(ScheduledPosts.id == post.id, ScheduledPosts.posted == False) \
+                .update({'posted': True, 'status': STATUS_SENDING}, synchronize_session=False)
+            db.session.commit()
+            if not claimed:
+                logger.debug(f"Post {post.id} has already been claimed by another worker.")
+                return
+
             post_data = post.post_data
 
             logger.debug(f"Attempting to send Post {post.id}")
             try:
-                send_post(post_data)
+                deferred = send_post(post_data)
                 logger.debug(f"Post {post.id} has been successfully sent.")
+                if deferred:
+                    schedule_retry(post_data, deferred)
             except Exception as e:
                 logger.error(f"Error occurred while sending Post {post.id}: {str(e)}")
+                post.status = STATUS_FAILED
+                post.posted = False
+                db.session.commit()
                 return
 
             logger.debug(f"Attempting to delete Post {post.id} from the database")
@@ -257,6 +489,37 @@ def send_scheduled_post(post_id):
         else:
             logger.debug(f"Post {post.id} is not yet due to be posted.")
 
+def prestage_scheduled_post(post_id):
+    logger.debug('prestage_scheduled_post function triggered')
+
+    with scheduler.app.app_context():
+        # Claim the pre-stage atomically, like sending, so only one worker uploads the media
+        claimed = ScheduledPosts.query.filter(ScheduledPosts.id == post_id, ScheduledPosts.posted == False,
+                                              ScheduledPosts.status == STATUS_SCHEDULED) \
+            .update({'status': STATUS_STAGING}, synchronize_session=False)
+        db.session.commit()
+        if not claimed:
+            return
+
+        post = db.session.get(ScheduledPosts, post_id)
+        post_data = dict(post.post_data)
+        try:
+            post_data['staged'] = prestage_post(post_data)
+        except Exception as e:
+            logger.error(f"Error occurred while pre-staging Post {post_id}: {str(e)}")
+            post_data['staged'] = {}
+
+        # Only store the staged ids if the post has not been sent in the meantime; a send that
+        # failed meanwhile has reset posted but left its own status, which must not be overwritten
+        stored = ScheduledPosts.query.filter(ScheduledPosts.id == post_id, ScheduledPosts.posted == False,
+                                             ScheduledPosts.status == STATUS_STAGING) \
+            .update({'post_data': post_data, 'status': STATUS_STAGED}, synchronize_session=False)
+        db.session.commit()
+        if stored:
+            logger.debug(f"Post {post_id} pre-staged for: {', '.join(post_data['staged']) or 'no platform'}")
+        else:
+            logger.warning(f"Post {post_id} was sent before pre-staging finished; staged media is left unused")
+
 def timed_execution(function, *args, **kwargs):
     start = time.time()
     result = function(*args, **kwargs)
@@ -0,0 +1,107 @@
+# history.py
+# What the platforms returned for every post: remote ids and URLs (for retries, edits and
+# deletes) and latency and payload size (for per-platform performance analysis).
+import os
+from datetime import datetime
+from urllib.parse import urlparse
+
+from sqlalchemy import insert, update, func, case
+
+import configLog
+from extensions import db
+from models import PostHistory, PLATFORMS, STATUS_PUBLISHED, STATUS_FAILED, STATUS_DELETED
+
+logger, speed_logger = configLog.configure_logging()
+
+def payload_bytes(text, image_locations):
+    # Rendered text plus the JPEGs that were uploaded, as the platforms read them from static/temp
+    size = len((text or '').encode('utf-8'))
+    for image_location in image_locations or []:
+        try:
+            size += os.path.getsize(urlparse(image_location).path[1:])
+        except OSError:
+            pass
+    return size
+
+def record_results(post_key, results, sizes, hashtag_text=None, alt_texts=None):
+    # results: {platform: (result, seconds)} from helpers.call_platforms; one multi-row INSERT for all of them.
+    # hashtag_text and alt_texts are kept so that edits can render the post again, see helpers.change_post
+    rows = [{
+        'post_key': post_key,
+        'platform': platform,
+        'status': STATUS_PUBLISHED if result else STATUS_FAILED,
+        'remote_id': str(result['remote_id']) if result else None,
+        'url': result.get('url') if result else None,
+        'latency_ms': int(seconds * 1000),
+        'payload_bytes': sizes.get(platform),
+        'created_at': datetime.utcnow(),
+        'hashtag_text': hashtag_text,
+        'alt_texts': alt_texts or [],
+        'media_ids': result.get('media_ids') if result else None,
+    } for platform, (result, seconds) in results.items()]
+    if not rows:
+        return
+    try:
+        db.session.execute(insert(PostHistory), rows)
+        db.session.commit()
+    except Exception as e:
+        # Losing history must never turn a published post into a failed one
+        db.session.rollback()
+        logger.error(f"Unable to record the history of post {post_key}: {e}")
+
+def published(post_key):
+    # {platform: PostHistory} of the platforms this post already went out on
+    rows = PostHistory.query.filter(PostHistory.post_key == post_key, PostHistory.status == STATUS_PUBLISHED)
+    return {row.platform: row for row in rows}
+
+def mark_deleted(post_key, platforms):
+    # One UPDATE for every platform the post was removed from
+    if not platforms:
+        return
+    db.session.execute(update(PostHistory)
+                       .where(PostHistory.post_key == post_key, PostHistory.platform.in_(platforms),
+                              PostHistory.status == STATUS_PUBLISHED)
+                       .values(status=STATUS_DELETED))
+    db.session.commit()
+
+def list_history(post_key=None, platform=None, limit=100):
+    query = PostHistory.query
+    if post_key:
+        query = query.filter(PostHistory.post_key == post_key)
+    if platform:
+        query = query.filter(PostHistory.platform == platform)
+    rows = query.order_by(PostHistory.created_at.desc(), PostHistory.id.desc()).limit(limit)
+    return [{
+        'post_key': row.post_key,
+        'platform': row.platform,
+        'status': row.status,
+        'remote_id': row.remote_id,
+        'url': row.url,
+        'latency_ms': row.latency_ms,
+        'payload_bytes': row.payload_bytes,
+        'created_at': row.created_at.isoformat(),
+    } for row in rows]
+
+def platform_stats(since=None):
+    # Sends, failures, average latency and payload per platform, from the platform/created_at index
+    query = db.session.query(
+        PostHistory.platform,
+        func.count(PostHistory.id),
+        func.sum(case((PostHistory.status == STATUS_FAILED, 1), else_=0)),
+        func.avg(PostHistory.latency_ms),
+        func.max(PostHistory.latency_ms),
+        func.avg(PostHistory.payload_bytes),
+    )
+    if since:
+        query = query.filter(PostHistory.created_at >= since)
+    stats = {platform: {'sent': 0, 'failed': 0, 'avg_latency_ms': None, 'max_latency_ms': None, 'avg_payload_bytes': None}
+             for platform in PLATFORMS}
+    for platform, sent, failed, avg_latency, max_latency, avg_payload in query.group_by(PostHistory.platform):
+        stats[platform] = {
+            'sent': sent,
+            'failed': int(failed or 0),
+            'avg_latency_ms': round(avg_latency) if avg_latency is not None else None,
+            'max_latency_ms': max_latency,
+            'avg_payload_bytes': round(avg_payload) if avg_payload is not None else None,
+        }
+    return stats
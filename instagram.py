@@ -1,28 +1,36 @@
 import logging
-import requests
+import asyncio
 import json
-import helpers
+import aio
+import media
 from config import (INSTAGRAM_USER_ID, USER_ACCESS_TOKEN)
-from concurrent.futures import ThreadPoolExecutor
 import configLog
 
 logger, speed_logger = configLog.configure_logging()
 
 ig_user_id = INSTAGRAM_USER_ID
 user_access_token = USER_ACCESS_TOKEN
-base_url = f'https://graph.facebook.com/v13.0/{ig_user_id}'
+graph_url = 'https://graph.facebook.com/v13.0'
+base_url = f'{graph_url}/{ig_user_id}'
+CONTAINER_POLL_SECONDS = 3
+CONTAINER_POLL_ATTEMPTS = 100
 
 def check_response(response):
     if response.status_code != 200:
-        logging.error(f"Request failed with status {response.status_code}, response: {response.text}")
+        logging.error("Request failed with status %s, response: %s", response.status_code, configLog.payload(response.text))
         return False
-    logging.debug(f"Request succeeded with status {response.status_code}, response: {response.text}")
+    logging.debug("Request succeeded with status %s, response: %s", response.status_code, configLog.payload(response.text))
     return True
 
-def post_to_ig(endpoint, payload):
+async def post_to_ig(endpoint, payload):
     url = f'{base_url}/{endpoint}'
-    logging.debug(f"Posting to URL: {url} with payload: {payload}")
-    r = requests.post(url, data=payload)
+    logging.debug("Posting to URL: %s with payload: %s", url,
+                  configLog.payload({key: value for key, value in payload.items() if key != 'access_token'}))
+    try:
+        r = await aio.get_client().post(url, data=payload)
+    except Exception as e:
+        logging.error(f"Request to {url} failed: {e}")
+        return None
     if not check_response(r):  # if the request failed
         return None  # return None to indicate failure
     result = json.loads(r.text)
@@ -31,93 +39,132 @@ def post_to_ig(endpoint, payload):
     return id  # return the id if the request was successful
 
 
-def create_item_container(image_url):
-    payload = {
-        'image_url': image_url,  
-        'is_carousel_item': True,  
-        'access_token': user_access_token  
-    }  
-    id = post_to_ig('media', payload)
+def media_payload(url, carousel_item):
+    # Instagram fetches the media itself from our URL; videos become Reels, or video items of a carousel
+    if media.is_video(url):
+        return {'video_url': url, 'media_type': 'VIDEO' if carousel_item else 'REELS'}
+    return {'image_url': url}
+
+async def wait_until_ready(container_id):
+    # Video containers are processed asynchronously and can only be used once they are FINISHED
+    for _ in range(CONTAINER_POLL_ATTEMPTS):
+        try:
+            r = await aio.get_client().get(f'{graph_url}/{container_id}',
+                                           params={'fields': 'status_code', 'access_token': user_access_token})
+            status = r.json().get('status_code')
+        except Exception as e:
+            logging.error(f"Status request for container {container_id} failed: {e}")
+            return False
+        if status == 'FINISHED':
+            return True
+        if status in ('ERROR', 'EXPIRED'):
+            logging.error('Container %s failed with status %s', container_id, status)
+            return False
+        await asyncio.sleep(CONTAINER_POLL_SECONDS)
+    logging.error('Container %s was not ready in time', container_id)
+    return False
+
+async def create_item_container(image_url):
+    payload = dict(media_payload(image_url, carousel_item=True), is_carousel_item=True, access_token=user_access_token)
+    id = await post_to_ig('media', payload)
+    if id and media.is_video(image_url) and not await wait_until_ready(id):
+        id = None
     if id:
         logging.info('Item container created for image URL: %s', image_url)
     else:
         logging.error('Failed to create item container for image URL: %s', image_url)
     return id
 
-def create_carousel_container(children, text):
+async def create_carousel_container(children, text):
     payload = {  
         'children': ','.join(children),
         'media_type': 'CAROUSEL',
-        'caption': helpers.strip_html_tags(text) + ' #midjourney #aiart #aiartcommunity #generativeai #synthography #postphotography',
+        'caption': text,
         'access_token': user_access_token  
     }  
-    id = post_to_ig('media', payload)
+    id = await post_to_ig('media', payload)
     if id:
         logging.info('Carousel container created')
     else:
         logging.error('Failed to create carousel container')
     return id
 
-def publish_carousel_container(creation_id):
+async def publish_carousel_container(creation_id):
     payload = {  
         'creation_id': creation_id,
         'access_token': user_access_token  
     }  
-    id = post_to_ig('media_publish', payload)  
+    id = await post_to_ig('media_publish', payload)  
     if id:
         logging.info('Carousel container published')
     else:
         logging.error('Failed to publish carousel container')
+    return id
 
-def postInstagramCarousel(image_locations, text):
+async def postInstagramCarousel(image_locations, text):
     logger.info('postInstagramCarousel function called with image locations: %s and text: %s', image_locations, text)
+    state = await prepare_post(image_locations, text)
+    return state is not None and await publish_post(state)
+
+async def prepare_post(image_locations, text):
+    # Create the (unpublished) containers ahead of time; the returned state is all publish_post needs
     if len(image_locations) == 1:
-        return postInstagramSingleImage(image_locations[0], text)
+        creation_id = await create_item_container_single_image(image_locations[0], text)
+        return {'creation_id': creation_id, 'single': True, 'text': text} if creation_id else None
 
-    # Create a ThreadPoolExecutor
-    with ThreadPoolExecutor() as executor:
-        # Submit tasks to the executor
-        futures = {executor.submit(create_item_container, image_url) for image_url in image_locations}
-        # Gather the results as they become available
-        children = [future.result() for future in futures if future.result() is not None]
+    # Create the item containers concurrently; gather keeps them in the order of the images
+    children = await asyncio.gather(*(
+        aio.bounded('instagram', aio.MAX_CONCURRENT_UPLOADS, create_item_container(image_url))
+        for image_url in image_locations
+    ))
+    children = [child for child in children if child is not None]
 
     if children:
-        carousel_id = create_carousel_container(children, text)
+        carousel_id = await create_carousel_container(children, text)
+        if carousel_id and any(media.is_video(url) for url in image_locations) and not await wait_until_ready(carousel_id):
+            carousel_id = None
         if carousel_id:
-            return publish_carousel_container(carousel_id)
+            return {'creation_id': carousel_id, 'single': False, 'text': text}
 
-    return False  # return False if the operation failed
+    return None  # return None if the operation failed
 
+async def publish_post(state):
+    # Returns the media id of the new post, False on failure; the permalink would cost another request
+    if state['single']:
+        media_id = await publish_single_image_container(state['creation_id'], state['text'])
+    else:
+        media_id = await publish_carousel_container(state['creation_id'])
+    return {'remote_id': media_id, 'url': None} if media_id else False
 
-def postInstagramSingleImage(image_url, text):
+async def postInstagramSingleImage(image_url, text):
     logger.info('postInstagramSingleImage function called with image URL: %s and text: %s', image_url, text)
-    media_id = create_item_container_single_image(image_url, text)
-    if media_id:
-        return publish_single_image_container(media_id, text)
-    return False  # return False if the operation failed
+    state = await prepare_post([image_url], text)
+    return state is not None and await publish_post(state)
 
 
-def create_item_container_single_image(image_url, text):
-    payload = {
-        'image_url': image_url,
-        'caption': helpers.strip_html_tags(text) + ' #midjourney #aiart #aiartcommunity #generativeai #synthography #postphotography',
-        'access_token': user_access_token
-    }
-    id = post_to_ig('media', payload)
+async def create_item_container_single_image(image_url, text):
+    payload = dict(media_payload(image_url, carousel_item=False), caption=text, access_token=user_access_token)
+    id = await post_to_ig('media', payload)
+    if id and media.is_video(image_url) and not await wait_until_ready(id):
+        id = None
     if id:
         logging.info('Single item container created for image URL: %s', image_url)
     else:
         logging.error('Failed to create single item container for image URL: %s', image_url)
     return id
 
-def publish_single_image_container(creation_id, text):
+async def publish_single_image_container(creation_id, text):
     payload = {
         'creation_id': creation_id,
-        'caption': helpers.strip_html_tags(text) + ' #midjourney #aiart #aiartcommunity #generativeai #synthography #postphotography',
+        'caption': text,
         'access_token': user_access_token
     }
-    id = post_to_ig('media_publish', payload)
+    id = await post_to_ig('media_publish', payload)
     if id:
         logging.info('Single image container published')
     else:
         logging.error('Failed to publish single image container')
+    return id
+
+async def probe():
+    return await aio.reachable(graph_url)
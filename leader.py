@@ -0,0 +1,97 @@
+# leader.py
+# Leader election for running several gunicorn workers (or hosts) against one database.
+# Every worker starts its scheduler paused, so any worker can still add jobs to the shared
+# job store, but only the worker holding the 'dispatch' lease row resumes it and runs jobs.
+import os
+import uuid
+import atexit
+import socket
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+import configLog
+from extensions import db, scheduler
+from models import SchedulerLease
+
+logger, speed_logger = configLog.configure_logging()
+
+LEASE_NAME = 'dispatch'
+DEFAULT_LEASE_SECONDS = 30
+
+worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+def try_acquire_lease(lease_seconds, name=LEASE_NAME):
+    # Atomically take over (or renew) the lease if it is ours or has expired; True if we hold it afterwards
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=lease_seconds)
+    updated = SchedulerLease.query.filter(
+        SchedulerLease.name == name,
+        or_(SchedulerLease.holder == worker_id, SchedulerLease.expires_at < now),
+    ).update({'holder': worker_id, 'expires_at': expires_at}, synchronize_session=False)
+    db.session.commit()
+    if updated:
+        return True
+
+    if db.session.get(SchedulerLease, name) is None:
+        try:
+            db.session.add(SchedulerLease(name=name, holder=worker_id, expires_at=expires_at))
+            db.session.commit()
+            return True
+        except IntegrityError:
+            db.session.rollback()  # another worker created it first
+    return False
+
+def release_lease(name=LEASE_NAME):
+    SchedulerLease.query.filter_by(name=name, holder=worker_id).delete(synchronize_session=False)
+    db.session.commit()
+
+class LeaderElection(threading.Thread):
+    def __init__(self, app, lease_seconds=DEFAULT_LEASE_SECONDS):
+        super().__init__(name='scheduler-leader-election', daemon=True)
+        self.app = app
+        self.lease_seconds = lease_seconds
+        self.is_leader = False
+        self.stopped = threading.Event()
+
+    def run(self):
+        # Renew well within the lease so a healthy leader never lets it lapse
+        while not self.stopped.is_set():
+            self.tick()
+            self.stopped.wait(self.lease_seconds / 3)
+
+    def tick(self):
+        with self.app.app_context():
+            try:
+                leader = try_acquire_lease(self.lease_seconds)
+            except Exception as e:
+                logger.exception(f'Scheduler lease check failed: {e}')
+                db.session.rollback()
+                leader = False
+
+        if leader and not self.is_leader:
+            logger.info(f'{worker_id} became scheduler leader')
+            scheduler.resume()
+        elif not leader and self.is_leader:
+            logger.info(f'{worker_id} lost scheduler leadership')
+            scheduler.pause()
+        elif leader:
+            # Pick up jobs that other workers have added to the shared job store since the last tick
+            scheduler.scheduler.wakeup()
+        self.is_leader = leader
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_leader:
+            scheduler.pause()
+            with self.app.app_context():
+                release_lease()
+
+def start_leader_election(app):
+    election = LeaderElection(app, app.config.get('SCHEDULER_LEASE_SECONDS', DEFAULT_LEASE_SECONDS))
+    scheduler.start(paused=True)
+    election.start()
+    atexit.register(election.stop)
+    return election
@@ -0,0 +1,199 @@
+# linkcards.py
+# Link preview cards: Open Graph metadata and thumbnails of the links in a post, fetched
+# concurrently with short timeouts and kept in an in-process LRU cache with a TTL, so a link
+# that comes up again in the content calendar is not fetched again. Runs on the loop in aio.py.
+# The URLs come from post texts, so only public addresses are fetched, on every redirect hop.
+# Failures of these third-party sites are not outages of the platform being posted to.
+import asyncio
+import ipaddress
+import socket
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+from io import BytesIO
+from urllib.parse import urljoin
+
+import httpx
+from PIL import Image
+
+import aio
+import configLog
+
+logger, speed_logger = configLog.configure_logging()
+
+CACHE_SIZE = 256
+CACHE_TTL = 24 * 60 * 60
+FAILURE_TTL = 5 * 60             # links without a card (timeouts, 5xx, no Open Graph tags) are tried again sooner
+FETCH_TIMEOUT = httpx.Timeout(5.0, connect=3.0)
+FETCH_DEADLINE = 5.0             # for a whole fetch, however slowly the server sends its bytes
+MAX_REDIRECTS = 5
+MAX_HTML_BYTES = 512 * 1024      # Open Graph tags live in <head>; the rest of the page is not needed
+MAX_THUMB_BYTES = 1000000        # Bluesky's blob limit for external embed thumbnails
+THUMB_MAX_EDGE = 1200
+USER_AGENT = 'Mozilla/5.0 (compatible; social-cross-post link preview)'
+
+class LRUCache:
+    # Least recently used entries are dropped first; entries older than ttl count as missing
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(key, None)
+            return default
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def set(self, key, value, ttl=None):
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+_cards = LRUCache()
+_inflight = {}
+
+class UnsafeURL(Exception):
+    pass
+
+async def check_public(url):
+    # Refuse URLs whose host resolves to a private, loopback, link-local or otherwise non-public address
+    if url.scheme not in ('http', 'https') or not url.host:
+        raise UnsafeURL(f'{url} is not an http(s) URL')
+    port = url.port or (443 if url.scheme == 'https' else 80)
+    try:
+        addresses = await asyncio.get_running_loop().getaddrinfo(url.host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise UnsafeURL(f'{url.host} does not resolve: {e}')
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise UnsafeURL(f'{url.host} resolves to the non-public address {address}')
+
+async def fetch_public(url, limit):
+    # (response, first limit bytes of the body) of a 200 answer, or None; redirects are followed
+    # by hand so every hop is checked
+    url = httpx.URL(url)
+    for _ in range(MAX_REDIRECTS + 1):
+        await check_public(url)
+        async with aio.get_client().stream('GET', url, timeout=FETCH_TIMEOUT, follow_redirects=False,
+                                           headers={'User-Agent': USER_AGENT}) as response:
+            if response.is_redirect:
+                url = response.url.join(response.headers['location'])
+                continue
+            if response.status_code != 200:
+                return None
+            return response, await read_limited(response, limit)
+    raise UnsafeURL(f'more than {MAX_REDIRECTS} redirects')
+
+class MetaParser(HTMLParser):
+    # Collects og:* and the plain <title>/description fallbacks up to the end of <head>
+    def __init__(self):
+        super().__init__()
+        self.meta = {}
+        self.title = ''
+        self._in_title = False
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        attrs = dict(attrs)
+        if tag == 'meta':
+            key = attrs.get('property') or attrs.get('name')
+            if key and attrs.get('content') and key.lower() not in self.meta:
+                self.meta[key.lower()] = attrs['content'].strip()
+        elif tag == 'title':
+            self._in_title = True
+        elif tag == 'body':
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'head':
+            self.done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+
+def parse_card(url, html):
+    parser = MetaParser()
+    parser.feed(html)
+    meta = parser.meta
+    title = meta.get('og:title') or meta.get('twitter:title') or parser.title.strip()
+    if not title:
+        return None
+    image = meta.get('og:image') or meta.get('og:image:url') or meta.get('twitter:image')
+    return {
+        'url': meta.get('og:url') or url,
+        'title': title,
+        'description': meta.get('og:description') or meta.get('description') or '',
+        'image': urljoin(url, image) if image else None,
+    }
+
+async def read_limited(response, limit):
+    data = bytearray()
+    async for chunk in response.aiter_bytes():
+        data += chunk
+        if len(data) >= limit:
+            break
+    return bytes(data[:limit])
+
+async def fetch_card(url):
+    try:
+        fetched = await asyncio.wait_for(aio.untracked(fetch_public(url, MAX_HTML_BYTES)), FETCH_DEADLINE)
+        if fetched is None or 'html' not in fetched[0].headers.get('content-type', ''):
+            return None
+        response, body = fetched
+        return parse_card(str(response.url), body.decode(response.encoding or 'utf-8', errors='replace'))
+    except Exception as e:
+        logger.info(f'No link card for {url}: {e!r}')
+        return None
+
+async def get_card(url):
+    # Cached, and concurrent requests for the same link share one fetch; failures only for FAILURE_TTL
+    if url in _cards:
+        return _cards.get(url)
+    if url not in _inflight:
+        _inflight[url] = asyncio.ensure_future(fetch_card(url))
+    try:
+        card = await _inflight[url]
+    finally:
+        _inflight.pop(url, None)
+    _cards.set(url, card, None if card else FAILURE_TTL)
+    return card
+
+def shrink_thumbnail(data):
+    # Re-encode thumbnails that are over the blob limit or not a format every platform takes
+    with Image.open(BytesIO(data)) as image:
+        if len(data) <= MAX_THUMB_BYTES and image.format in ('JPEG', 'PNG'):
+            return data, Image.MIME[image.format]
+        image = image.convert('RGB')
+        image.thumbnail((THUMB_MAX_EDGE, THUMB_MAX_EDGE))
+        output = BytesIO()
+        image.save(output, 'JPEG', quality=85)
+        return output.getvalue(), 'image/jpeg'
+
+async def fetch_thumbnail(image_url):
+    # (bytes, mime type) of a card's image, or None
+    try:
+        fetched = await asyncio.wait_for(aio.untracked(fetch_public(image_url, 10 * MAX_THUMB_BYTES)), FETCH_DEADLINE)
+        if fetched is None:
+            return None
+        data, mime_type = await asyncio.to_thread(shrink_thumbnail, fetched[1])
+    except Exception as e:
+        logger.info(f'No thumbnail from {image_url}: {e!r}')
+        return None
+    if len(data) > MAX_THUMB_BYTES:
+        return None
+    return data, mime_type
@@ -1,39 +1,122 @@
-from mastodon import Mastodon
+import os
+import asyncio
+import aio
+import media
 import configLog
 from urllib.parse import urlparse
 from config import (MASTODON_ACCESS_TOKEN, MASTODON_API_BASE_URL)
 
 logger, speed_logger = configLog.configure_logging()
 
-def post_to_mastodon(subject, body, image_locations, alt_texts):
-    mastodon = Mastodon(
-        access_token=MASTODON_ACCESS_TOKEN,
-        api_base_url=MASTODON_API_BASE_URL
-    )
+# Mastodon.py accepted a bare host name, so keep accepting one here
+API_BASE_URL = (MASTODON_API_BASE_URL if MASTODON_API_BASE_URL.startswith('http')
+                else f'https://{MASTODON_API_BASE_URL}').rstrip('/')
+HEADERS = {'Authorization': f'Bearer {MASTODON_ACCESS_TOKEN}'}
 
-    media_ids = []
-    for idx, image_location in enumerate(image_locations):
+MEDIA_POLL_SECONDS = 2
+MEDIA_PROCESSING_TIMEOUT = 10 * 60  # a video still processing after this long is given up on
+
+async def upload_media(local_file_path, alt_text):
+    if media.is_video(local_file_path):
+        return await upload_video(local_file_path, alt_text)
+
+    # Open the image file from its location
+    with open(local_file_path, "rb") as image_file:
+        files = {'file': (os.path.basename(local_file_path), image_file.read(), 'image/jpeg')}
+
+    r = await aio.get_client().post(f'{API_BASE_URL}/api/v2/media', headers=HEADERS, files=files,
+                                    data={'description': alt_text or ''})
+    r.raise_for_status()  # 202 means the upload is accepted and still being processed, which is fine for images
+    return r.json()['id']
+
+async def upload_video(local_file_path, alt_text):
+    # Mastodon has no chunked upload; the file object is streamed from disk by the multipart encoder.
+    # Videos are processed asynchronously (202) and cannot be attached before they are done.
+    with open(local_file_path, "rb") as video_file:
+        files = {'file': (os.path.basename(local_file_path), video_file, 'video/mp4')}
+        r = await aio.get_client().post(f'{API_BASE_URL}/api/v2/media', headers=HEADERS, files=files,
+                                        data={'description': alt_text or ''})
+    r.raise_for_status()
+    media_id = r.json()['id']
+    if r.status_code == 202 or r.json().get('url') is None:
         try:
+            await asyncio.wait_for(wait_for_processing(media_id), MEDIA_PROCESSING_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f'Mastodon was still processing video {media_id} after {MEDIA_PROCESSING_TIMEOUT} seconds')
+            return None
+    return media_id
+
+async def wait_for_processing(media_id):
+    while True:
+        await asyncio.sleep(MEDIA_POLL_SECONDS)
+        r = await aio.get_client().get(f'{API_BASE_URL}/api/v1/media/{media_id}', headers=HEADERS)
+        if r.status_code != 206:  # 206 Partial Content: still processing
+            r.raise_for_status()
+            return
+
+async def post_to_mastodon(subject, body, image_locations, alt_texts):
+    state = await prepare_status(subject, body, image_locations, alt_texts)
+    return state is not None and await publish_status(state)
+
+async def prepare_status(subject, body, image_locations, alt_texts):
+    # Upload the media ahead of time; the returned state is all publish_status needs
+    try:
+        uploads = []
+        for idx, image_location in enumerate(image_locations):
             # Parse the URL and get the path
             url_parts = urlparse(image_location)
             local_file_path = url_parts.path[1:]  # Remove the leading '/'
+            uploads.append(aio.bounded('mastodon', aio.MAX_CONCURRENT_UPLOADS, upload_media(local_file_path, alt_texts[idx])))
+        media_ids = await asyncio.gather(*uploads)
+    except Exception as e:
+        logger.exception(f"Unable to process one of the attachments for Mastodon. Error: {e}")
+        return None  # Return None if there is an error in posting the image
+    if None in media_ids:
+        return None
 
-            # Open the image file from its location
-            with open(local_file_path, "rb") as image_file:
-                media = mastodon.media_post(image_file.read(), mime_type='image/jpeg', description=alt_texts[idx])
-                media_ids.append(media['id'])
-
-        except Exception as e:
-            logger.exception(f"Unable to process one of the attachments for Mastodon. Error: {e}")
-            return False  # Return False if there is an error in posting the image
+    return {'body': body, 'media_ids': list(media_ids)}
 
+async def publish_status(state):
+    # Returns the id and URL of the new status, False on failure
     try:
-        if media_ids:  # Check if there are media attachments
-            mastodon.status_post(body, media_ids=media_ids)
-        else:
-            mastodon.status_post(body)
+        payload = {'status': state['body']}
+        if state['media_ids']:  # Check if there are media attachments
+            payload['media_ids[]'] = state['media_ids']
+        r = await aio.get_client().post(f'{API_BASE_URL}/api/v1/statuses', headers=HEADERS, data=payload)
+        r.raise_for_status()
+        status = r.json()
     except Exception as e:
         logger.exception(f"Unable to post the status to Mastodon. Error: {e}")
         return False  # Return False if there is an error in posting the status
 
-    return True  # Return True if the post is successful
+    return {'remote_id': status['id'], 'url': status.get('url'), 'media_ids': state['media_ids']}
+
+async def delete_status(status_id):
+    try:
+        r = await aio.get_client().delete(f'{API_BASE_URL}/api/v1/statuses/{status_id}', headers=HEADERS)
+        r.raise_for_status()
+    except Exception as e:
+        logger.exception(f"Unable to delete Mastodon status {status_id}. Error: {e}")
+        return False
+    return True
+
+async def edit_status(status_id, body, media_ids=(), alt_texts=()):
+    # An edit replaces the whole status: attachments whose ids are not sent again are removed, so the
+    # stored media ids go with every edit, together with their alt texts. JSON keeps each id with its
+    # description, which repeated form fields would not.
+    payload = {'status': body}
+    if media_ids:
+        payload['media_ids'] = list(media_ids)
+        alt_texts = list(alt_texts)
+        payload['media_attributes'] = [{'id': media_id, 'description': (alt_texts[idx] if idx < len(alt_texts) else None) or ''}
+                                       for idx, media_id in enumerate(media_ids)]
+    try:
+        r = await aio.get_client().put(f'{API_BASE_URL}/api/v1/statuses/{status_id}', headers=HEADERS, json=payload)
+        r.raise_for_status()
+    except Exception as e:
+        logger.exception(f"Unable to edit Mastodon status {status_id}. Error: {e}")
+        return False
+    return True
+
+async def probe():
+    return await aio.reachable(f'{API_BASE_URL}/api/v1/instance')
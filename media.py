@@ -0,0 +1,200 @@
+# media.py
+# Media type detection and the video pipeline. Images keep going through process_files;
+# videos and animated GIFs are transcoded to MP4 by a local ffmpeg that reads the upload
+# from disk and writes the result to disk, once per platform profile the post needs.
+import os
+import json
+import time
+import fcntl
+import shutil
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from PIL import Image
+
+import configLog
+
+logger, speed_logger = configLog.configure_logging()
+
+FFMPEG = shutil.which('ffmpeg') or 'ffmpeg'
+FFPROBE = shutil.which('ffprobe') or 'ffprobe'
+
+KIND_IMAGE = 'image'
+KIND_VIDEO = 'video'  # also animated GIFs, which every platform wants as a video
+
+# ISO-BMFF brands of still images (HEIF/HEIC as iPhones take them, AVIF); they share the ftyp box with MP4
+IMAGE_BRANDS = {b'heic', b'heix', b'heim', b'heis', b'hevc', b'hevx', b'mif1', b'msf1', b'avif', b'avis', b'avci'}
+
+VIDEO_EXTENSION = '.mp4'
+CHUNK_SIZE = 4 * 1024 * 1024  # read size for chunked uploads, so a video is never held in memory as a whole
+TRANSCODE_TIMEOUT = 30 * 60
+# Lock files, one per core, shared by every worker on the host; see _transcode_slot
+SLOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'temp', 'transcode_slots')
+TRANSCODE_SLOTS = os.cpu_count() or 1
+SLOT_POLL = 0.5  # seconds between looks for a free slot
+
+# H.264/AAC in MP4 with the index up front is what every platform accepts
+PROFILES = {
+    'sd': {'max_edge': 1280, 'max_fps': 30, 'video_bitrate': '4M', 'audio_bitrate': '128k'},
+    'hd': {'max_edge': 1920, 'max_fps': 30, 'video_bitrate': '8M', 'audio_bitrate': '192k'},
+}
+PLATFORM_PROFILES = {
+    'twitter': 'hd',
+    'mastodon': 'hd',
+    'bluesky': 'sd',
+    'facebook': 'hd',
+    'instagram': 'hd',
+    'posthaven': 'sd',  # goes out as a mail attachment
+}
+
+# Threads that wait for a slot; each ffmpeg is limited to one thread, see _transcode_slot
+_transcoder = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='transcode')
+
+class MediaError(Exception):
+    pass
+
+def sniff(stream):
+    # Tell videos and animated GIFs from still images by their first bytes
+    head = stream.read(16)
+    stream.seek(0)
+    if head[4:8] == b'ftyp':
+        return KIND_IMAGE if head[8:12] in IMAGE_BRANDS else KIND_VIDEO
+    if head[:4] == b'\x1aE\xdf\xa3' or (head[:4] == b'RIFF' and head[8:12] == b'AVI '):
+        return KIND_VIDEO
+    if head[:4] == b'GIF8':
+        try:
+            with Image.open(stream) as image:
+                animated = getattr(image, 'is_animated', False)
+        except Exception:
+            animated = False
+        finally:
+            stream.seek(0)
+        return KIND_VIDEO if animated else KIND_IMAGE
+    return KIND_IMAGE
+
+def is_video(location):
+    return location.lower().endswith(VIDEO_EXTENSION)
+
+def probe(path):
+    try:
+        result = subprocess.run(
+            [FFPROBE, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', path],
+            capture_output=True, text=True, timeout=60)
+    except FileNotFoundError:
+        raise MediaError('ffprobe is not installed on the server, videos cannot be posted')
+    except subprocess.TimeoutExpired:
+        raise MediaError(f'Reading {os.path.basename(path)} took too long')
+    if result.returncode != 0:
+        raise MediaError(f'{os.path.basename(path)} is not a readable video')
+    try:
+        info = json.loads(result.stdout)
+    except ValueError:
+        raise MediaError(f'{os.path.basename(path)} is not a readable video')
+    video = next((stream for stream in info.get('streams', []) if stream.get('codec_type') == 'video'), None)
+    if video is None:
+        raise MediaError(f'{os.path.basename(path)} has no video stream')
+    return {
+        'width': int(video.get('width', 0)),
+        'height': int(video.get('height', 0)),
+        'duration': float(info.get('format', {}).get('duration') or 0),
+        'has_audio': any(stream.get('codec_type') == 'audio' for stream in info.get('streams', [])),
+    }
+
+@contextmanager
+def _transcode_slot():
+    # Hold one of TRANSCODE_SLOTS lock files for as long as ffmpeg runs, so all workers together never
+    # run more transcodes than there are cores. The kernel drops the lock if a worker dies.
+    os.makedirs(SLOT_DIR, exist_ok=True)
+    start = time.time()
+    while True:
+        for slot in range(TRANSCODE_SLOTS):
+            handle = open(os.path.join(SLOT_DIR, f'{slot}.lock'), 'a')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            waited = time.time() - start
+            if waited >= SLOT_POLL:
+                speed_logger.info(f'Transcode slot wait: {waited} seconds')
+            try:
+                yield slot
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+            return
+        time.sleep(SLOT_POLL)
+
+def transcode(source, target, profile_name):
+    profile = PROFILES[profile_name]
+    edge = profile['max_edge']
+    command = [
+        FFMPEG, '-nostdin', '-v', 'error', '-y', '-i', source,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-vf', f'scale=w=min(iw\\,{edge}):h=min(ih\\,{edge}):force_original_aspect_ratio=decrease:force_divisible_by=2',
+        '-fpsmax', str(profile['max_fps']),
+        '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'high', '-pix_fmt', 'yuv420p',
+        '-b:v', profile['video_bitrate'], '-maxrate', profile['video_bitrate'], '-bufsize', profile['video_bitrate'],
+        '-c:a', 'aac', '-b:a', profile['audio_bitrate'], '-ac', '2',
+        '-movflags', '+faststart', '-threads', '1',
+        f'{target}.tmp{VIDEO_EXTENSION}',
+    ]
+    with _transcode_slot():
+        start = time.time()
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, timeout=TRANSCODE_TIMEOUT)
+        except FileNotFoundError:
+            raise MediaError('ffmpeg is not installed on the server, videos cannot be posted')
+        except subprocess.TimeoutExpired:
+            _remove(f'{target}.tmp{VIDEO_EXTENSION}')
+            raise MediaError(f'Transcoding {os.path.basename(source)} took longer than {TRANSCODE_TIMEOUT // 60} minutes')
+    if result.returncode != 0:
+        _remove(f'{target}.tmp{VIDEO_EXTENSION}')
+        raise MediaError(f'Transcoding {os.path.basename(source)} failed: {result.stderr.strip()[-500:]}')
+    os.replace(f'{target}.tmp{VIDEO_EXTENSION}', target)
+    speed_logger.info(f"Transcode of {os.path.basename(source)} to {profile_name} execution time: {time.time() - start} seconds")
+    return target
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def variant_name(basename, profile_name):
+    return f'{basename}_{profile_name}{VIDEO_EXTENSION}'
+
+def variant_profiles(platforms):
+    # The profiles the given platforms need; the first one's variant stands for the video in image_locations
+    return sorted({PLATFORM_PROFILES[platform] for platform in platforms}) or ['hd']
+
+def transcode_variants(source, folder, basename, platforms):
+    # One transcode per distinct profile of the given platforms, run in parallel; returns the
+    # paths of the variants in the order of variant_profiles
+    profiles = variant_profiles(platforms)
+    futures = [_transcoder.submit(transcode, source, os.path.join(folder, variant_name(basename, profile)), profile)
+               for profile in profiles]
+    # Wait for every transcode before giving up on one, so none is still writing when the caller cleans up
+    wait(futures)
+    failed = next((future.exception() for future in futures if future.exception()), None)
+    if failed:
+        for future in futures:
+            if not future.exception():
+                _remove(future.result())
+        raise failed
+    return [future.result() for future in futures]
+
+def variant(location, platform):
+    # Path or URL of a platform's variant of a video; variants only differ in their profile suffix
+    if not is_video(location):
+        return location
+    stem = location[:-len(VIDEO_EXTENSION)]
+    for profile_name in PROFILES:
+        if stem.endswith(f'_{profile_name}'):
+            return stem[:-len(profile_name)] + PLATFORM_PROFILES[platform] + VIDEO_EXTENSION
+    return location
+
+def locations_for(post_data, platform):
+    # The media URLs one platform gets: videos are swapped for that platform's profile
+    return [variant(location, platform) for location in post_data['image_locations']]
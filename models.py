@@ -1,9 +1,109 @@
 # models.py
+import uuid
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+
 from extensions import db
 
+PLATFORMS = ('twitter', 'instagram', 'posthaven', 'bluesky', 'mastodon', 'facebook')
+
+STATUS_SCHEDULED = 'scheduled'
+STATUS_STAGING = 'staging'
+STATUS_STAGED = 'staged'
+STATUS_SENDING = 'sending'
+STATUS_FAILED = 'failed'
+STATUS_PUBLISHED = 'published'
+STATUS_DELETED = 'deleted'
+
+def new_post_key():
+    return uuid.uuid4().hex
+
 class ScheduledPosts(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     text = db.Column(db.Text, nullable=False)
-    scheduled_time = db.Column(db.DateTime, nullable=False)
+    scheduled_time = db.Column(db.DateTime, nullable=False, index=True)
     post_data = db.Column(db.PickleType, nullable=False)
-    posted = db.Column(db.Boolean, default=False)
\ No newline at end of file
+    posted = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_SCHEDULED, server_default=STATUS_SCHEDULED)
+
+    # Platforms are mirrored into their own table so the queue can be filtered without unpickling post_data
+    platforms = db.relationship('ScheduledPostPlatforms', cascade='all, delete-orphan', lazy='select')
+
+    __table_args__ = (
+        db.Index('ix_scheduled_posts_status_time', 'status', 'scheduled_time', 'id'),
+    )
+
+    @classmethod
+    def from_post_data(cls, post_data, scheduled_time):
+        post_data.setdefault('post_key', new_post_key())  # kept across retries, see history.py
+        post = cls(text=post_data.get('text'), scheduled_time=scheduled_time, post_data=post_data)
+        post.platforms = [ScheduledPostPlatforms(platform=platform)
+                          for platform in PLATFORMS if post_data.get(f'enable_{platform}')]
+        return post
+
+class ScheduledPostPlatforms(db.Model):
+    post_id = db.Column(db.Integer, db.ForeignKey('scheduled_posts.id', ondelete='CASCADE'), primary_key=True)
+    platform = db.Column(db.String(16), primary_key=True)
+
+    __table_args__ = (
+        db.Index('ix_scheduled_post_platforms_platform', 'platform', 'post_id'),
+    )
+
+class PostHistory(db.Model):
+    # One row per platform a post was sent to. post_key groups the platforms of one cross-post;
+    # remote_id/url identify the published post on the platform for later edits and deletes.
+    id = db.Column(db.Integer, primary_key=True)
+    post_key = db.Column(db.String(32), nullable=False)
+    platform = db.Column(db.String(16), nullable=False)
+    status = db.Column(db.String(16), nullable=False)
+    remote_id = db.Column(db.String(255))
+    url = db.Column(db.String(512))
+    latency_ms = db.Column(db.Integer)
+    payload_bytes = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # What an edit needs to render the post like the original: the hashtag block and alt texts
+    # that were added to the text, and the media ids of the attachments (Mastodon drops any an edit omits)
+    hashtag_text = db.Column(db.Text)
+    alt_texts = db.Column(db.JSON)
+    media_ids = db.Column(db.JSON)
+
+    __table_args__ = (
+        db.Index('ix_post_history_post_key', 'post_key', 'platform'),
+        db.Index('ix_post_history_platform_time', 'platform', 'created_at'),
+        db.Index('ix_post_history_remote_id', 'platform', 'remote_id'),
+    )
+
+class SchedulerLease(db.Model):
+    # One row per lease; whoever holds an unexpired lease is the only process allowed to dispatch
+    name = db.Column(db.String(32), primary_key=True)
+    holder = db.Column(db.String(128), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+def upgrade_schema():
+    # db.create_all() never alters existing tables, so bring databases created by older versions up to date
+    inspector = inspect(db.engine)
+    table = ScheduledPosts.__tablename__
+    columns = {column['name'] for column in inspector.get_columns(table)}
+
+    if 'status' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text(
+                f"ALTER TABLE {table} ADD COLUMN status VARCHAR(16) NOT NULL DEFAULT '{STATUS_SCHEDULED}'"))
+
+        # One-off backfill of the platform table for posts scheduled before it existed
+        for post in ScheduledPosts.query.all():
+            post.platforms = [ScheduledPostPlatforms(platform=platform)
+                              for platform in PLATFORMS if post.post_data.get(f'enable_{platform}')]
+        db.session.commit()
+
+    for index in ScheduledPosts.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+    history_table = PostHistory.__table__
+    columns = {column['name'] for column in inspector.get_columns(history_table.name)}
+    for name in ('hashtag_text', 'alt_texts', 'media_ids'):
+        if name not in columns:
+            column_type = history_table.columns[name].type.compile(dialect=db.engine.dialect)
+            with db.engine.begin() as connection:
+                connection.execute(text(f"ALTER TABLE {history_table.name} ADD COLUMN {name} {column_type}"))
@@ -0,0 +1,52 @@
+# platforms.py
+# Registry of the platform modules. A platform's module - and with it its dependencies
+# and credentials - is only imported the first time something is actually sent to that
+# platform. Every function listed here is a coroutine run on the shared loop in aio.py.
+#
+# send(*args) posts in one go. prepare(*args) does the slow part ahead of time (media
+# uploads, unpublished containers) and returns a picklable state, or None on failure;
+# publish(state) then only makes the final, cheap call.
+#
+# delete(remote_id) and edit(remote_id, text) change a published post by the remote id
+# stored in post_history; None where the platform's API cannot do it. Mastodon's edit also
+# takes the stored media ids and alt texts, see helpers.change_post.
+#
+# probe() is a cheap health check used by the circuit breakers in breaker.py: True as soon
+# as the platform answers at all (an auth error still proves it is up).
+import importlib
+
+REGISTRY = {
+    'twitter': {'name': 'Twitter', 'module': 'twitter',
+                'send': 'upload_to_twitter', 'prepare': 'prepare_tweet', 'publish': 'publish_tweet',
+                'delete': 'delete_tweet', 'edit': None, 'probe': 'probe'},
+    'mastodon': {'name': 'Mastodon', 'module': 'masto',
+                 'send': 'post_to_mastodon', 'prepare': 'prepare_status', 'publish': 'publish_status',
+                 'delete': 'delete_status', 'edit': 'edit_status', 'probe': 'probe'},
+    'bluesky': {'name': 'Bluesky', 'module': 'bluesky',
+                'send': 'post_to_bluesky', 'prepare': 'prepare_post', 'publish': 'publish_post',
+                'delete': 'delete_post', 'edit': None, 'probe': 'probe'},
+    'posthaven': {'name': 'Posthaven', 'module': 'posthaven',
+                  'send': 'send_email_with_attachments', 'prepare': 'prepare_email', 'publish': 'publish_email',
+                  'delete': None, 'edit': None, 'probe': 'probe'},
+    'facebook': {'name': 'Facebook', 'module': 'facebook',
+                 'send': 'post_to_facebook', 'prepare': 'prepare_post', 'publish': 'publish_post',
+                 'delete': 'delete_post', 'edit': 'edit_post', 'probe': 'probe'},
+    'instagram': {'name': 'Instagram', 'module': 'instagram',
+                  'send': 'postInstagramCarousel', 'prepare': 'prepare_post', 'publish': 'publish_post',
+                  'delete': None, 'edit': None, 'probe': 'probe'},
+}
+
+def display_name(platform):
+    return REGISTRY[platform]['name']
+
+def load_module(platform):
+    return importlib.import_module(REGISTRY[platform]['module'])  # cached in sys.modules after the first call
+
+def supports(platform, kind):
+    return REGISTRY[platform][kind] is not None
+
+def get_function(platform, kind):
+    return getattr(load_module(platform), REGISTRY[platform][kind])
+
+def get_sender(platform):
+    return get_function(platform, 'send')
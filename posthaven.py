@@ -1,25 +1,48 @@
+import os
+import asyncio
+import socket
 import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
+from email.utils import make_msgid
+import aio
 import configLog
 from config import (FASTMAIL_USERNAME, FASTMAIL_PASSWORD, EMAIL_RECIPIENTS)
 from urllib.parse import urlparse
 
 logger, speed_logger = configLog.configure_logging()
 
-def send_email_with_attachments(subject, body, image_locations, alt_texts):
+SMTP_HOST = 'smtp.fastmail.com'
+SMTP_PORT = 587
+# Failures that mean the mail server is unreachable rather than that it refused the mail
+OUTAGE_ERRORS = (smtplib.SMTPServerDisconnected, TimeoutError, ConnectionError, socket.gaierror)
+SMTP_TIMEOUT = 30  # seconds for the connect and every later command; smtplib waits forever without it
+
+async def send_email_with_attachments(subject, body, image_locations, alt_texts):
+    state = await prepare_email(subject, body, image_locations, alt_texts)
+    return await publish_email(state)
+
+async def prepare_email(subject, body, image_locations, alt_texts):
+    # Nothing to upload ahead of time: the whole message goes out in one SMTP session
+    return {'subject': subject, 'body': body, 'image_locations': image_locations, 'alt_texts': alt_texts}
+
+async def publish_email(state):
+    # There is no SMTP client on the shared HTTP engine; run the blocking send in a worker thread
+    return await asyncio.to_thread(send_email, state['subject'], state['body'], state['image_locations'], state['alt_texts'])
+
+def send_email(subject, body, image_locations, alt_texts):
+    # Returns the Message-ID of the sent mail, False on failure; Posthaven does not report the post it creates
     msg = MIMEMultipart()
+    msg['Message-ID'] = make_msgid()
     msg['From'] = FASTMAIL_USERNAME
     msg['To'] = ', '.join(EMAIL_RECIPIENTS)
     msg['Subject'] = subject
 
     if image_locations:
+        # body already lists the alt texts, see render.py
         for idx, image_location in enumerate(image_locations):
-            alt_text = alt_texts[idx] if idx < len(alt_texts) else ""
-            body += f'Image {idx+1}: <i><small>{alt_text if alt_text else "No alt text provided"}</small></i><br>'
-
             try:
                 # Parse the URL and get the path
                 url_parts = urlparse(image_location)
@@ -30,7 +53,8 @@ def send_email_with_attachments(subject, body, image_locations, alt_texts):
                     part = MIMEBase('application', 'octet-stream')
                     part.set_payload(attachment.read())
                     encoders.encode_base64(part)
-                    part.add_header('Content-Disposition', f"attachment; filename= {idx+1}.jpg")
+                    extension = os.path.splitext(local_file_path)[1] or '.jpg'  # videos are attached as .mp4
+                    part.add_header('Content-Disposition', f"attachment; filename= {idx+1}{extension}")
                     msg.attach(part)
 
             except Exception as e:
@@ -40,7 +64,7 @@ def send_email_with_attachments(subject, body, image_locations, alt_texts):
     msg.attach(MIMEText(body, 'html'))  # Attach the body with alt text appended
 
     try:
-        with smtplib.SMTP('smtp.fastmail.com', 587) as server:
+        with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT) as server:
             server.starttls()
             server.login(FASTMAIL_USERNAME, FASTMAIL_PASSWORD)
             server.sendmail(FASTMAIL_USERNAME, EMAIL_RECIPIENTS, msg.as_string())
@@ -48,10 +72,21 @@ def send_email_with_attachments(subject, body, image_locations, alt_texts):
         if e.smtp_code == 250:  # Email was sent successfully
             logger.info(f"Email sent successfully. Response: {e.smtp_error}")
         else:  # There was a problem
+            if 400 <= e.smtp_code < 500:  # 4xx replies are temporary, e.g. the server is overloaded
+                aio.report_outage(f'{SMTP_HOST}: SMTP {e.smtp_code}')
             logger.exception(f"Failed to send email. Error: {e.smtp_error}")
             return False  # Return False if there is an error in sending the email
     except Exception as e:  # Some other exception occurred
+        if isinstance(e, OUTAGE_ERRORS):
+            aio.report_outage(f'{SMTP_HOST}: {type(e).__name__}')
         logger.exception(f"Failed to send email. Error: {e}")
         return False  # Return False if there is an exception
 
-    return True  # Return True if the email is sent successfully
+    return {'remote_id': msg['Message-ID'], 'url': None}
+
+def smtp_noop():
+    with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=5) as server:
+        return server.noop()[0] == 250
+
+async def probe():
+    return await asyncio.to_thread(smtp_noop)
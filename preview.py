@@ -0,0 +1,112 @@
+# preview.py
+# Server side previews for the compose form. Uploads are keyed by the SHA-256 of their bytes:
+# a small preview is decoded at reduced scale right away, and the full JPEG that process_files
+# would write is encoded in the background so the real submit can copy it instead.
+import os
+import glob
+import hashlib
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image
+
+import configLog
+
+logger, speed_logger = configLog.configure_logging()
+
+PREVIEW_MAX_EDGE = 400
+PREVIEW_CACHE_ENTRIES = 200
+JPEG_QUALITY = 90  # the quality process_files posts with
+
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix='preview')
+
+def cache_dir(root_path):
+    return os.path.join(root_path, 'static/temp/previews')
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+def preview_path(root_path, digest):
+    return os.path.join(cache_dir(root_path), f'{digest}.jpg')
+
+def encoded_path(root_path, digest):
+    return os.path.join(cache_dir(root_path), f'{digest}.full.jpg')
+
+def _write_atomic(image, path, **kwargs):
+    # Readers either see the finished file or none at all
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    image.save(tmp_path, 'JPEG', **kwargs)
+    os.replace(tmp_path, path)
+
+def render_preview(data, path, max_edge=PREVIEW_MAX_EDGE):
+    # JPEGs are decoded at 1/2 to 1/8 scale by draft(); other formats are shrunk with reduce()
+    # before the final resample, so a 50 MP photo never has to be decoded at full size
+    with Image.open(BytesIO(data)) as image:
+        width, height, source_format = image.width, image.height, image.format
+        image.draft('RGB', (max_edge, max_edge))
+        small = image.convert('RGB')
+        factor = max(small.size) // max_edge
+        if factor > 1:
+            small = small.reduce(factor)  # cheap box reduction, the resample below only does the rest
+        small.thumbnail((max_edge, max_edge))
+        _write_atomic(small, path, quality=JPEG_QUALITY)
+    return {'format': source_format, 'width': width, 'height': height}
+
+def encode_full(data, path):
+    # Exactly what process_files does with an upload
+    if os.path.exists(path):
+        return path
+    with Image.open(BytesIO(data)) as image:
+        _write_atomic(image.convert('RGB'), path, quality=JPEG_QUALITY)
+    return path
+
+def _encode_in_background(data, path):
+    try:
+        encode_full(data, path)
+    except Exception as e:
+        logger.warning(f'Background encode of {os.path.basename(path)} failed: {e}')
+
+def get_preview(root_path, data, cache_entries=PREVIEW_CACHE_ENTRIES):
+    # Returns the content hash and image info; the preview file is ready when this returns
+    os.makedirs(cache_dir(root_path), exist_ok=True)
+    digest = content_hash(data)
+    path = preview_path(root_path, digest)
+    with Image.open(BytesIO(data)) as image:  # header only
+        info = {'format': image.format, 'width': image.width, 'height': image.height}
+    if os.path.exists(path):
+        os.utime(path)  # keeps recently used previews out of prune_cache
+    else:
+        render_preview(data, path)
+        prune_cache(root_path, cache_entries)
+
+    full = encoded_path(root_path, digest)
+    if os.path.exists(full):
+        info['bytes'] = os.path.getsize(full)
+    else:
+        info['bytes'] = None  # known once the background encode is done; ask again for it
+        _executor.submit(_encode_in_background, data, full)
+    return digest, info
+
+def copy_encoded(root_path, data, target_path):
+    # Reuse the background encode of an upload that was previewed; False if there is none yet
+    source = encoded_path(root_path, content_hash(data))
+    try:
+        shutil.copyfile(source, target_path)
+    except FileNotFoundError:
+        return False
+    return True
+
+def prune_cache(root_path, cache_entries=PREVIEW_CACHE_ENTRIES):
+    # Keep the newest previews (and their full encodes), oldest first out
+    previews = [path for path in glob.glob(os.path.join(cache_dir(root_path), '*.jpg')) if not path.endswith('.full.jpg')]
+    if len(previews) <= cache_entries:
+        return
+    previews.sort(key=os.path.getmtime)
+    for path in previews[:len(previews) - cache_entries]:
+        for stale in (path, path[:-len('.jpg')] + '.full.jpg'):
+            try:
+                os.remove(stale)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,136 @@
+# render.py
+# Renders the final text of a post for every platform in one place. The result is stored
+# in post_data['rendered'], so it is computed once per post (also for scheduled posts)
+# and the platform modules just send what they are given.
+import re
+import unicodedata
+
+import helpers
+import richtext
+
+try:
+    import regex  # proper extended grapheme clusters when the package is installed
+except ImportError:
+    regex = None
+
+INSTAGRAM_HASHTAGS = '#midjourney #aiart #aiartcommunity #generativeai #synthography #postphotography'
+TWITTER_ALT_PROMPT = '[prompts over on Bluesky & Mastodon]'
+FACEBOOK_ALT_PROMPT = '[image prompts below]'
+ALT_PROMPT = '[prompt in the alt]'
+
+# Length limits per platform; None means no practical limit
+TEXT_LIMITS = {
+    'twitter': 280,
+    'mastodon': 500,
+    'bluesky': 300,
+    'instagram': 2200,
+    'facebook': 63206,
+    'posthaven': None,
+}
+URL_LENGTH = 23  # Twitter and Mastodon count every link as 23 characters
+
+ZERO_WIDTH_JOINER = '\u200d'
+BR_PATTERN = re.compile(r'<br\s*/?>', re.IGNORECASE)
+
+def graphemes(text):
+    # Split text into user-perceived characters
+    if regex is not None:
+        return regex.findall(r'\X', text)
+
+    # Fallback: keep combining marks, variation selectors, skin tones and ZWJ sequences with their base
+    clusters = []
+    join_next = False
+    for char in text:
+        code = ord(char)
+        extends = (unicodedata.combining(char) or 0xFE00 <= code <= 0xFE0F or 0x1F3FB <= code <= 0x1F3FF
+                   or 0xE0020 <= code <= 0xE007F or char == ZERO_WIDTH_JOINER)
+        regional_pair = (0x1F1E6 <= code <= 0x1F1FF and clusters and len(clusters[-1]) == 1
+                         and 0x1F1E6 <= ord(clusters[-1]) <= 0x1F1FF)
+        if clusters and (extends or join_next or regional_pair):
+            clusters[-1] += char
+        else:
+            clusters.append(char)
+        join_next = char == ZERO_WIDTH_JOINER
+    return clusters
+
+def _twitter_weight(cluster):
+    # twitter-text counts Latin, general punctuation etc. as 1 and everything else (CJK, emoji) as 2
+    code = ord(cluster[0])
+    light = code <= 4351 or 8192 <= code <= 8205 or 8208 <= code <= 8223 or 8242 <= code <= 8247
+    return 1 if light else 2
+
+def text_length(platform, text):
+    if platform in ('twitter', 'mastodon'):
+        # Links have a fixed length there, whatever their real length is
+        urls = richtext.URL_PATTERN.findall(text)
+        remainder = richtext.URL_PATTERN.sub('', text)
+        if platform == 'twitter':
+            return len(urls) * URL_LENGTH + sum(_twitter_weight(cluster) for cluster in graphemes(remainder))
+        return len(urls) * URL_LENGTH + len(graphemes(remainder))
+    return len(graphemes(text))
+
+def truncate(platform, text, ellipsis='…'):
+    # Cut at a grapheme boundary so the text (plus ellipsis) fits the platform's limit
+    limit = TEXT_LIMITS.get(platform)
+    if limit is None or text_length(platform, text) <= limit:
+        return text
+    clusters = graphemes(text)
+    low, high = 0, len(clusters)
+    while low < high:  # longest prefix that still fits
+        middle = (low + high + 1) // 2
+        if text_length(platform, ''.join(clusters[:middle]).rstrip() + ellipsis) <= limit:
+            low = middle
+        else:
+            high = middle - 1
+    return ''.join(clusters[:low]).rstrip() + ellipsis
+
+def html_to_text(html):
+    return helpers.strip_html_tags(BR_PATTERN.sub('\n', html))
+
+def render_post(post_data):
+    text_mastodon = post_data['text_mastodon']
+    alt_texts = post_data.get('processed_alt_texts') or []
+
+    facebook_text = text_mastodon
+    if alt_texts:
+        alt_text_str = "\n\n".join(filter(None, alt_texts))  # Filter out empty alt texts and join them with line breaks
+        facebook_text = text_mastodon.replace(ALT_PROMPT, FACEBOOK_ALT_PROMPT) + "\n\n" + alt_text_str
+
+    posthaven_body = post_data['text']
+    for idx, alt_text in enumerate(alt_texts):
+        posthaven_body += f'Image {idx+1}: <i><small>{alt_text if alt_text else "No alt text provided"}</small></i><br>'
+
+    return {
+        'twitter': helpers.strip_html_tags(text_mastodon).replace(ALT_PROMPT, TWITTER_ALT_PROMPT),
+        'mastodon': text_mastodon,
+        'bluesky': helpers.strip_html_tags(text_mastodon),
+        'posthaven': posthaven_body,
+        'facebook': facebook_text,
+        'instagram': html_to_text(post_data['text']) + ' ' + INSTAGRAM_HASHTAGS,
+    }
+
+def length_errors(post_data, rendered=None):
+    # Over-length texts of the enabled platforms, as human readable messages
+    rendered = rendered or get_rendered(post_data)
+    errors = []
+    for platform, limit in TEXT_LIMITS.items():
+        if limit is None or not post_data.get(f'enable_{platform}'):
+            continue
+        length = text_length(platform, rendered[platform])
+        if length > limit:
+            errors.append(f'{platform.capitalize()} text is {length} characters long, the limit is {limit}.')
+    return errors
+
+def prepare(post_data, truncate_overlong=False):
+    # Render once and store the result with the post; returns the length errors that remain
+    rendered = render_post(post_data)
+    if truncate_overlong:
+        rendered = {platform: truncate(platform, text) for platform, text in rendered.items()}
+    post_data['rendered'] = rendered
+    return length_errors(post_data, rendered)
+
+def get_rendered(post_data):
+    # Posts scheduled before rendering existed have no cached texts yet
+    if 'rendered' not in post_data:
+        post_data['rendered'] = render_post(post_data)
+    return post_data['rendered']
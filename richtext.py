@@ -0,0 +1,128 @@
+# richtext.py
+# Single pass rich-text scanner: finds links, mentions and hashtags once and derives both
+# Bluesky facets (which need UTF-8 byte offsets, not character offsets) and HTML links
+# from the same scan. Standard library only, so it can be imported and benchmarked anywhere.
+# A short post with mentions or hashtags costs about twice the old links-only regex (some µs),
+# since those are found as well; posts without '@'/'#' take a links-only fast path. Numbers:
+# python tests/bench_richtext.py
+import re
+from collections import namedtuple
+
+URL_PATTERN = re.compile(r'https?://[^\s<>"\'\]\[{}|\\^`]+')
+
+# Every token starts with 'h', '@' or '#': the lookahead rejects all other positions in one step,
+# and each lookbehind (what may not come right before a mention or a tag) is only evaluated once
+# the '@' or '#' itself has matched
+TOKEN_PATTERN = re.compile(r'''
+    (?=[h@\#])
+    (?:
+        (?P<url>https?://[^\s<>"'\]\[{}|\\^`]+)
+      | @(?<![\w@.]@)(?P<mention>(?:[a-zA-Z0-9](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?\.)+[a-zA-Z](?:[a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)
+      | \#(?<![\w#&/]\#)(?P<tag>[^\d\s\#][^\s\#]*)
+    )
+''', re.VERBOSE)
+
+TRAILING_PUNCTUATION = '.,;:!?\'"'
+MAX_TAG_LENGTH = 64
+
+# kind is 'link', 'mention' or 'tag'; value is the URI, handle or tag without '@'/'#';
+# start/end are character offsets, byte_start/byte_end UTF-8 byte offsets of the whole token
+Token = namedtuple('Token', 'kind value start end byte_start byte_end')
+
+def _trim_url(url):
+    # Drop trailing punctuation and a closing parenthesis that has no opening one in the URL
+    while url:
+        if url[-1] in TRAILING_PUNCTUATION:
+            url = url[:-1]
+        elif url[-1] == ')' and url.count('(') < url.count(')'):
+            url = url[:-1]
+        else:
+            break
+    return url
+
+def _trim_tag(tag):
+    return tag.rstrip(TRAILING_PUNCTUATION + ')')[:MAX_TAG_LENGTH]
+
+def scan(text, links=True, mentions=True, tags=True):
+    tokens = []
+    ascii_only = text.isascii()  # byte offsets equal character offsets, nothing to encode
+    char_pos = byte_pos = 0
+    pattern = TOKEN_PATTERN
+    if '@' not in text and '#' not in text:
+        # Only links can match: URL_PATTERN alone is several times cheaper on short posts. A skipped
+        # mention or tag still consumes its characters, so this is not done for mentions=False.
+        if not links:
+            return tokens
+        pattern = URL_PATTERN
+    for match in pattern.finditer(text):
+        kind = match.lastgroup or 'url'
+        if kind == 'url':
+            if not links:
+                continue
+            value = _trim_url(match.group(0))
+            start = match.start()
+            end = start + len(value)
+            kind = 'link'
+        elif kind == 'mention':
+            if not mentions:
+                continue
+            value = match.group('mention')
+            start, end = match.start(), match.end()
+        else:
+            if not tags:
+                continue
+            value = _trim_tag(match.group('tag'))
+            if not value:
+                continue
+            start = match.start()
+            end = start + 1 + len(value)
+
+        if ascii_only:
+            byte_start, byte_end = start, end
+        else:
+            # Only the text since the previous token is encoded, so the whole scan stays linear
+            byte_start = byte_pos + len(text[char_pos:start].encode('utf-8'))
+            byte_end = byte_start + len(text[start:end].encode('utf-8'))
+            char_pos, byte_pos = end, byte_end
+        tokens.append(Token(kind, value, start, end, byte_start, byte_end))
+    return tokens
+
+def find_urls(text):
+    return [token.value for token in scan(text, mentions=False, tags=False)]
+
+def _facet(token, feature):
+    return {
+        "index": {
+            "byteStart": token.byte_start,
+            "byteEnd": token.byte_end
+        },
+        "features": [feature]
+    }
+
+def bluesky_facets(tokens, dids=None):
+    # dids maps mention handles to DIDs; mentions that could not be resolved are left as plain text
+    dids = dids or {}
+    facets = []
+    for token in tokens:
+        if token.kind == 'link':
+            facets.append(_facet(token, {"$type": "app.bsky.richtext.facet#link", "uri": token.value}))
+        elif token.kind == 'tag':
+            facets.append(_facet(token, {"$type": "app.bsky.richtext.facet#tag", "tag": token.value}))
+        elif token.kind == 'mention' and token.value.lower() in dids:
+            facets.append(_facet(token, {"$type": "app.bsky.richtext.facet#mention", "did": dids[token.value.lower()]}))
+    return facets
+
+def html_links(text, tokens=None):
+    # Wrap every link in an <a> tag, building the result in one join instead of re-slicing per match
+    if tokens is None:
+        tokens = scan(text, mentions=False, tags=False)
+    parts = []
+    pos = 0
+    for token in tokens:
+        if token.kind != 'link':
+            continue
+        parts.append(text[pos:token.start])
+        parts.append(f'<a href="{token.value}">{token.value}</a>')
+        pos = token.end
+    parts.append(text[pos:])
+    return ''.join(parts)
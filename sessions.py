@@ -0,0 +1,93 @@
+# sessions.py
+# Session handling that stays off the hot paths. Static files (the images the platforms
+# fetch) and requests with an API token get a throwaway session: nothing is read or stored.
+# Other /api/ requests read the session but never write it back. With SESSION_TYPE = 'memory'
+# the UI sessions live in a dict in the worker instead of Flask-Session's backend and expire
+# after PERMANENT_SESSION_LIFETIME without use.
+import copy
+import secrets
+import threading
+import time
+
+from flask import request
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+import configLog
+
+logger, speed_logger = configLog.configure_logging()
+
+API_PREFIX = '/api/'
+
+class MemorySession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+class TransientSession(MemorySession):
+    # Usable like any session, but thrown away at the end of the request
+    pass
+
+class MemorySessionInterface(SessionInterface):
+    # Per process: with several gunicorn workers a login only holds on the worker that made it
+    def __init__(self):
+        self._store = {}
+        self._lock = threading.Lock()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            with self._lock:
+                entry = self._store.get(sid)
+            if entry and entry[0] > time.monotonic():
+                return MemorySession(copy.deepcopy(entry[1]), sid)
+        return MemorySession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if not session:
+            if session.modified and not session.new:
+                with self._lock:
+                    self._store.pop(session.sid, None)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        ttl = app.permanent_session_lifetime.total_seconds()
+        with self._lock:
+            if session.new:
+                self._prune()
+            self._store[session.sid] = (time.monotonic() + ttl, copy.deepcopy(dict(session)))
+        if self.should_set_cookie(app, session) or session.new:
+            response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session),
+                                domain=domain, path=path, httponly=self.get_cookie_httponly(app),
+                                secure=self.get_cookie_secure(app), samesite=self.get_cookie_samesite(app))
+
+    def _prune(self):
+        now = time.monotonic()
+        for sid in [sid for sid, (expires, _) in self._store.items() if expires <= now]:
+            del self._store[sid]
+
+class SelectiveSessionInterface(SessionInterface):
+    # Wraps the configured session interface and skips it where a session is not needed
+    def __init__(self, inner):
+        self.inner = inner
+
+    def skips_session(self, app, request):
+        if app.static_url_path and request.path.startswith(app.static_url_path + '/'):
+            return True
+        return request.headers.get('Authorization', '').lower().startswith('bearer ')
+
+    def open_session(self, app, request):
+        if self.skips_session(app, request):
+            return TransientSession()
+        return self.inner.open_session(app, request)
+
+    def save_session(self, app, session, response):
+        if isinstance(session, TransientSession) or request.path.startswith(API_PREFIX):
+            return
+        return self.inner.save_session(app, session, response)
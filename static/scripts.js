@@ -56,21 +56,59 @@ window.onload = function() {
                 };
                 div.appendChild(altInput);
 
+                var warnings = document.createElement('div');
+                warnings.className = 'preview-warnings';
+                div.appendChild(warnings);
+
                 fileList.appendChild(div);
 
-                // Read the image file as a data URL and display it
-                var reader = new FileReader();
-                reader.onload = (function(aImg) {
-                    return function(e) {
-                        aImg.src = e.target.result;
-                    };
-                })(img);
-                reader.readAsDataURL(files[i]);
+                loadPreview(files[i], img, warnings);
             }
         }
     }
 }
 
+var PLATFORM_CHECKBOXES = {
+    twitter: 'chkTW', mastodon: 'chkMS', bluesky: 'chkBS',
+    posthaven: 'chkPH', facebook: 'chkFB', instagram: 'chkIG'
+};
+
+// Show the server's low resolution preview of the JPEG that will actually be posted,
+// falling back to the local file if the server cannot make one
+function loadPreview(file, img, warnings) {
+    var data = new FormData();
+    data.append('file', file);
+    fetch('/api/preview', {method: 'POST', body: data, credentials: 'same-origin'})
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error('preview failed');
+            }
+            return response.json();
+        })
+        .then(function(preview) {
+            img.src = preview.url;
+            var messages = [];
+            for (var platform in preview.platforms) {
+                var checkbox = document.getElementById(PLATFORM_CHECKBOXES[platform]);
+                if (checkbox && checkbox.checked) {
+                    messages = messages.concat(preview.platforms[platform]);
+                }
+            }
+            warnings.textContent = messages.join(' ');
+        })
+        .catch(function() {
+            if (file.type.indexOf('video/') === 0) {
+                img.alt = file.name;  // videos are previewed by name only
+                return;
+            }
+            var reader = new FileReader();
+            reader.onload = function(e) {
+                img.src = e.target.result;
+            };
+            reader.readAsDataURL(file);
+        });
+}
+
 function disableSubmitButton() {
     var submitButton = document.getElementById('submitButton');
     submitButton.disabled = true;
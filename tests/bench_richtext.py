@@ -0,0 +1,51 @@
+# bench_richtext.py
+# Compares the single pass richtext scanner with the previous per-match implementation:
+#   python tests/bench_richtext.py
+# The previous code only found links; the scanner also finds mentions and hashtags, so posts
+# with '@' or '#' do more work than before. Posts without them take the links-only fast path.
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import richtext
+
+OLD_URL_PATTERN = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+
+PARAGRAPHS = {
+    'mention+tag': 'Grüße aus Köln 🌧️ neue Serie: https://example.com/series?id=42 mit @artist.bsky.social #aiart. ',
+    'links only': 'Grüße aus Köln 🌧️ neue Serie: https://example.com/series?id=42 mit dem Künstler, bald mehr. ',
+}
+
+def old_urls_to_html_links(text_html):
+    url_format = '<a href="{}">{}</a>'
+    url_matches = list(OLD_URL_PATTERN.finditer(text_html))
+    for match in reversed(url_matches):
+        url = match.group(0)
+        start, end = match.span()
+        text_html = text_html[:start] + url_format.format(url, url) + text_html[end:]
+    return text_html
+
+def old_facets(text):
+    return [{"index": {"byteStart": m.start(), "byteEnd": m.end()},
+             "features": [{"$type": "app.bsky.richtext.facet#link", "uri": m.group(0)}]}
+            for m in OLD_URL_PATTERN.finditer(text)]
+
+def new_html_and_facets(text):
+    tokens = richtext.scan(text)
+    return richtext.html_links(text, tokens), richtext.bluesky_facets(tokens)
+
+def main():
+    for name, paragraph in PARAGRAPHS.items():
+        print(name)
+        for paragraphs in (1, 10, 100, 1000):
+            text = paragraph * paragraphs
+            runs = max(1, 20000 // paragraphs)
+            old = timeit.timeit(lambda: (old_urls_to_html_links(text), old_facets(text)), number=runs) / runs
+            new = timeit.timeit(lambda: new_html_and_facets(text), number=runs) / runs
+            print(f'{len(text):>9} chars: old {old * 1000:8.3f} ms   new {new * 1000:8.3f} ms   ({old / new:5.1f}x)')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+# Smoke test: the app factory builds an app that can serve a page.
+# config.py holds the deployment's credentials, so a minimal one is put in its place.
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    config = types.ModuleType('config')
+
+    class Config:
+        SECRET_KEY = 'test'
+        SESSION_TYPE = 'memory'
+        VERSION = 'test'
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'posts.db'}"
+        API_TOKEN_SECRET = 'test-token-secret'
+        TESTING = True
+
+    config.Config = Config
+    config.MYPASSWORD = 'password'
+    monkeypatch.setitem(sys.modules, 'config', config)
+    monkeypatch.chdir(ROOT)  # logging.conf is read from the working directory
+
+    import app as app_module
+    return app_module.create_app(start_scheduler=False)
+
+def test_create_app(app):
+    from sqlalchemy import inspect
+    from extensions import db
+    from models import ScheduledPosts
+
+    with app.app_context():
+        assert inspect(db.engine).has_table(ScheduledPosts.__tablename__)
+    client = app.test_client()
+    assert client.get('/login').status_code == 200
+    assert client.get('/').status_code == 302
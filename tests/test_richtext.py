@@ -0,0 +1,36 @@
+# Bluesky facets index the UTF-8 encoded text, so offsets after multi-byte characters must be byte offsets.
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import richtext
+
+def test_byte_offsets_after_multibyte_characters():
+    text = 'Grüße 🌧️ aus Köln: https://example.com/köln?id=1. Mit @artist.bsky.social #straßenkunst!'
+    encoded = text.encode('utf-8')
+    tokens = richtext.scan(text)
+
+    assert [(token.kind, token.value) for token in tokens] == [
+        ('link', 'https://example.com/köln?id=1'),
+        ('mention', 'artist.bsky.social'),
+        ('tag', 'straßenkunst'),
+    ]
+    for token in tokens:
+        assert text[token.start:token.end] == encoded[token.byte_start:token.byte_end].decode('utf-8')
+    assert encoded[tokens[0].byte_start:tokens[0].byte_end] == 'https://example.com/köln?id=1'.encode('utf-8')
+    assert encoded[tokens[1].byte_start:tokens[1].byte_end] == b'@artist.bsky.social'
+    assert encoded[tokens[2].byte_start:tokens[2].byte_end] == '#straßenkunst'.encode('utf-8')
+
+def test_links_only_fast_path():
+    # Without '@' or '#' only URL_PATTERN runs; the offsets must be the same as with the full pattern
+    text = 'Schöne Grüße 🌧️ https://example.com/a) und (https://example.com/b).'
+    tokens = richtext.scan(text)
+    encoded = text.encode('utf-8')
+    assert [token.value for token in tokens] == ['https://example.com/a', 'https://example.com/b']
+    for token in tokens:
+        assert encoded[token.byte_start:token.byte_end].decode('utf-8') == token.value
+    facets = richtext.bluesky_facets(tokens)
+    assert [facet['index'] for facet in facets] == [
+        {'byteStart': token.byte_start, 'byteEnd': token.byte_end} for token in tokens]
@@ -1,80 +1,111 @@
-from tweepy import Client
+import os
 import json
-import requests
-import helpers
-from requests_oauthlib import OAuth1
-from urllib.parse import urlparse
+import asyncio
+import functools
+import aio
+import media
+from oauthlib.oauth1 import Client as OAuth1Client
+from urllib.parse import urlparse, urlencode
 import configLog
 
 logger, speed_logger = configLog.configure_logging()
 
-# Load Twitter credentials from config.json
-with open("config.json", "r") as file:
-    twitter_config = json.load(file)
-
-# OAuth1 authentication
-auth = OAuth1(
-    twitter_config["consumer_key"],
-    twitter_config["consumer_secret"],
-    twitter_config["access_token"],
-    twitter_config["access_token_secret"],
-)
-
-# Create client object
-client = Client(
-    consumer_key=twitter_config["consumer_key"],
-    consumer_secret=twitter_config["consumer_secret"],
-    access_token=twitter_config["access_token"],
-    access_token_secret=twitter_config["access_token_secret"],
-)
-
-def upload_to_twitter(image_locations, alt_texts, text):
+UPLOAD_URL = 'https://upload.twitter.com/1.1/media/upload.json'
+TWEET_URL = 'https://api.twitter.com/2/tweets'
+
+@functools.lru_cache(maxsize=None)
+def get_twitter_config():
+    # Load Twitter credentials from config.json on first use rather than at import
+    with open("config.json", "r") as file:
+        return json.load(file)
+
+@functools.lru_cache(maxsize=None)
+def get_oauth():
+    twitter_config = get_twitter_config()
+    # OAuth1 authentication
+    return OAuth1Client(
+        twitter_config["consumer_key"],
+        client_secret=twitter_config["consumer_secret"],
+        resource_owner_key=twitter_config["access_token"],
+        resource_owner_secret=twitter_config["access_token_secret"],
+    )
+
+def oauth_headers(url, method='POST'):
+    # Multipart and JSON bodies are not part of the OAuth1 signature, so only the URL is signed
+    _, headers, _ = get_oauth().sign(url, http_method=method)
+    return headers
+
+async def upload_to_twitter(image_locations, alt_texts, text):
+    state = await prepare_tweet(image_locations, alt_texts, text)
+    return state is not None and await publish_tweet(state)
+
+async def prepare_tweet(image_locations, alt_texts, text):
+    # Upload the media ahead of time; the returned state is all publish_tweet needs
     try:
+        media_ids = []
         if image_locations:
-            media_ids = []
+            uploads = []
             for image_location, alt_text in zip(image_locations, alt_texts):
                 # Parse the URL and get the path
                 url_parts = urlparse(image_location)
                 local_file_path = url_parts.path[1:]  # Remove the leading '/'
 
                 # Get media id
-                media_id = upload_local_image(local_file_path, twitter_config, alt_text)
-                if not media_id:  # if media upload failed
-                    return False
-                media_ids.append(media_id)
-            
-            tweet_text = helpers.strip_html_tags(text)  # Customize as required
-            tweet_text = text.replace("[prompt in the alt]", "[prompts over on Bluesky & Mastodon]")  # Replace the string
-            res = client.create_tweet(text=tweet_text, media_ids=media_ids)
-        else:
-            tweet_text = helpers.strip_html_tags(text)
-            tweet_text = text.replace("[prompt in the alt]", "[prompts over on Bluesky & Mastodon]")
-            res = client.create_tweet(text=tweet_text)
+                if media.is_video(local_file_path):
+                    upload = upload_local_video(local_file_path)
+                else:
+                    upload = upload_local_image(local_file_path, get_twitter_config(), alt_text)
+                uploads.append(aio.bounded('twitter', aio.MAX_CONCURRENT_UPLOADS, upload))
+            media_ids = await asyncio.gather(*uploads)
+            if not all(media_ids):  # if media upload failed
+                return None
+    except Exception as e:
+        logger.exception(f"Failed to upload media to Twitter. Error: {e}")
+        return None
+
+    return {'text': text, 'media_ids': media_ids}  # text is already rendered for Twitter, see render.py
+
+async def publish_tweet(state):
+    # Returns the id and URL of the new tweet, False on failure
+    try:
+        payload = {'text': state['text']}
+        if state['media_ids']:
+            payload['media'] = {'media_ids': [str(media_id) for media_id in state['media_ids']]}
+
+        res = await aio.get_client().post(TWEET_URL, json=payload, headers=oauth_headers(TWEET_URL))
+        res.raise_for_status()
+        tweet_id = res.json()['data']['id']
     except Exception as e:
         logger.exception(f"Failed to post to Twitter. Error: {e}")
         return False
 
-    return True if res else False  # Return True if the tweet is created successfully, False otherwise
+    return {'remote_id': tweet_id, 'url': f'https://twitter.com/i/web/status/{tweet_id}'}
+
+async def delete_tweet(tweet_id):
+    url = f'{TWEET_URL}/{tweet_id}'
+    try:
+        res = await aio.get_client().delete(url, headers=oauth_headers(url, method='DELETE'))
+        res.raise_for_status()
+    except Exception as e:
+        logger.exception(f"Failed to delete tweet {tweet_id}. Error: {e}")
+        return False
+    return True
+
+async def upload_local_image(filepath, config, alt_text):
+    # Endpoint URL with additional parameters
+    url = f'{UPLOAD_URL}?media_category=TWEET_IMAGE'
 
-def upload_local_image(filepath, config, alt_text):
-    # Endpoint URL
-    url = 'https://upload.twitter.com/1.1/media/upload.json'
-   
     # File to upload
     try:
-        files = {'media': open(filepath, 'rb')}
+        with open(filepath, 'rb') as media:
+            files = {'media': media.read()}
     except Exception as e:
         logger.exception(f"Failed to open file {filepath}. Exception: {e}")
         return None
 
-    #logger.debug(f'Opened file {filepath}.')
-    
-    # Additional parameters
-    params = {'media_category': 'TWEET_IMAGE'}
-
     # Making the POST request
     try:
-        response = requests.post(url, files=files, params=params, auth=auth)
+        response = await aio.get_client().post(url, files=files, headers=oauth_headers(url))
         response.raise_for_status()
     except Exception as e:
         logger.exception(f"POST request failed. Exception: {e}")
@@ -86,4 +117,43 @@ def upload_local_image(filepath, config, alt_text):
     json_res = response.json()
     logger.debug(f"Received Media ID: {json_res['media_id']}")
 
-    return json_res["media_id"]
+    return json_res["media_id_string"]
+
+async def media_command(params, method='POST', **kwargs):
+    # Chunked upload commands; the parameters go in the query string so the OAuth1 signature covers them
+    url = f'{UPLOAD_URL}?{urlencode(params)}'
+    response = await aio.get_client().request(method, url, headers=oauth_headers(url, method), **kwargs)
+    response.raise_for_status()
+    return response.json() if response.content else {}
+
+async def upload_local_video(filepath):
+    # INIT / APPEND / FINALIZE, reading the file from disk one chunk at a time, then wait for processing
+    try:
+        init = await media_command({'command': 'INIT', 'total_bytes': os.path.getsize(filepath),
+                                    'media_type': 'video/mp4', 'media_category': 'tweet_video'})
+        media_id = init['media_id_string']
+
+        with open(filepath, 'rb') as video:
+            segment_index = 0
+            while chunk := await asyncio.to_thread(video.read, media.CHUNK_SIZE):
+                await media_command({'command': 'APPEND', 'media_id': media_id, 'segment_index': segment_index},
+                                    files={'media': chunk})
+                segment_index += 1
+
+        info = await media_command({'command': 'FINALIZE', 'media_id': media_id})
+        processing = info.get('processing_info')
+        while processing and processing['state'] in ('pending', 'in_progress'):
+            await asyncio.sleep(processing.get('check_after_secs', 1))
+            info = await media_command({'command': 'STATUS', 'media_id': media_id}, method='GET')
+            processing = info.get('processing_info')
+        if processing and processing['state'] == 'failed':
+            raise RuntimeError(processing.get('error'))
+    except Exception as e:
+        logger.exception(f"Video upload of {filepath} failed. Exception: {e}")
+        return None
+
+    logger.debug(f"Received Media ID: {media_id}")
+    return media_id
+
+async def probe():
+    return await aio.reachable('https://api.twitter.com/2/openapi.json')
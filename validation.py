@@ -0,0 +1,150 @@
+# validation.py
+# Pre-flight checks that run before any network I/O, so a post that one of the enabled
+# platforms would reject is refused up front instead of ending up half published.
+import os
+
+from PIL import Image, UnidentifiedImageError
+
+import configLog
+import media
+import render
+from models import PLATFORMS
+
+logger, speed_logger = configLog.configure_logging()
+
+# Input formats Pillow can decode and that process_files turns into JPEG
+SUPPORTED_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF', 'BMP', 'TIFF'}
+MAX_FILES = 4
+KIND_VIDEO = media.KIND_VIDEO
+
+MEDIA_LIMITS = {
+    'twitter': {'max_count': 4, 'max_bytes': 5 * 1024 * 1024, 'max_width': 8192, 'max_height': 8192,
+                'max_videos': 1, 'video_alone': True, 'max_video_bytes': 512 * 1024 * 1024, 'max_video_seconds': 140},
+    'mastodon': {'max_count': 4, 'max_bytes': 16 * 1024 * 1024, 'max_pixels': 7680 * 4320,
+                 'max_videos': 1, 'video_alone': True, 'max_video_bytes': 40 * 1024 * 1024},
+    'bluesky': {'max_count': 4, 'max_bytes': 1000000,
+                'max_videos': 1, 'video_alone': True, 'max_video_bytes': 100 * 1000 * 1000, 'max_video_seconds': 180},
+    'instagram': {'min_count': 1, 'max_count': 10, 'max_bytes': 8 * 1024 * 1024, 'min_width': 320,
+                  'min_aspect_ratio': 4 / 5, 'max_aspect_ratio': 1.91,
+                  'max_videos': 10, 'max_video_bytes': 300 * 1024 * 1024, 'max_video_seconds': 900},
+    'facebook': {'max_count': 10, 'max_bytes': 10 * 1024 * 1024,
+                 'max_videos': 1, 'video_alone': True, 'max_video_bytes': 1024 * 1024 * 1024},
+    'posthaven': {'max_bytes': 20 * 1024 * 1024, 'max_video_bytes': 20 * 1024 * 1024},
+}
+
+def inspect_image(source, name):
+    # Read only the image header: format and size, without decoding any pixels
+    try:
+        with Image.open(source) as image:
+            info = {'name': name, 'format': image.format, 'width': image.width, 'height': image.height}
+    except Image.DecompressionBombError as e:
+        # Pillow refuses to even open images this large, see Image.MAX_IMAGE_PIXELS
+        logger.info(f'Refused oversized image {name}: {e}')
+        return {'name': name, 'format': None, 'width': 0, 'height': 0,
+                'error': f'the image is too large to process (over {2 * Image.MAX_IMAGE_PIXELS} pixels)'}
+    except (UnidentifiedImageError, OSError):
+        return {'name': name, 'format': None, 'width': 0, 'height': 0}
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)  # leave uploads readable for process_files
+    return info
+
+def inspect_media(source, name):
+    # Like inspect_image, but videos and animated GIFs are recognised as such; their
+    # dimensions and duration are checked after transcoding, see validate_processed_media
+    if media.sniff(source) == media.KIND_VIDEO:
+        return {'name': name, 'format': 'VIDEO', 'kind': media.KIND_VIDEO, 'width': 0, 'height': 0}
+    return dict(inspect_image(source, name), kind=media.KIND_IMAGE)
+
+def enabled_platforms(post_data):
+    return [platform for platform in PLATFORMS if post_data.get(f'enable_{platform}')]
+
+def validate_post(post_data, media, require_alt_text=False):
+    # media: inspect_image() results in posting order. Returns a list of error messages.
+    errors = []
+    platforms = enabled_platforms(post_data)
+    alt_texts = post_data.get('processed_alt_texts') or []
+
+    if not platforms:
+        errors.append('Select at least one platform.')
+    if not render.html_to_text(post_data.get('text_html', '')).strip() and not media:
+        errors.append('A post needs text or at least one image.')
+    if len(media) > MAX_FILES:
+        errors.append(f'Maximum of {MAX_FILES} files are allowed.')
+
+    for idx, image in enumerate(media):
+        if image.get('kind') == KIND_VIDEO:
+            continue  # alt texts of videos are optional on every platform
+        if image.get('error'):
+            errors.append(f"{image['name']}: {image['error']}.")
+            continue
+        if image['format'] not in SUPPORTED_FORMATS:
+            errors.append(f"{image['name']}: unsupported file format {image['format'] or '(not an image)'}.")
+            continue
+        if require_alt_text and not (idx < len(alt_texts) and alt_texts[idx]):
+            errors.append(f"{image['name']}: alt text is missing.")
+
+    for platform in platforms:
+        limits = MEDIA_LIMITS[platform]
+        name = platform.capitalize()
+        if len(media) < limits.get('min_count', 0):
+            errors.append(f'{name} needs at least {limits["min_count"]} image.')
+        if len(media) > limits.get('max_count', MAX_FILES):
+            errors.append(f'{name} allows at most {limits["max_count"]} images.')
+        videos = sum(1 for image in media if image.get('kind') == KIND_VIDEO)
+        if videos > limits.get('max_videos', 1):
+            errors.append(f'{name} allows at most {limits.get("max_videos", 1)} video.')
+        if videos and limits.get('video_alone') and len(media) > videos:
+            errors.append(f'{name} cannot mix a video with images.')
+        for image in media:
+            errors.extend(image_errors(platform, image))
+
+    errors.extend(render.length_errors(post_data))
+    return errors
+
+def image_errors(platform, image, size=None):
+    # Checks of one inspect_image() result against a platform's limits; size is the encoded
+    # byte size if it is already known (see preview.py), otherwise validate_processed_media checks it
+    errors = []
+    if not image['format'] or image.get('kind') == KIND_VIDEO:
+        return errors
+    limits = MEDIA_LIMITS[platform]
+    name = platform.capitalize()
+    width, height = image['width'], image['height']
+    if width > limits.get('max_width', width) or height > limits.get('max_height', height):
+        errors.append(f"{name}: {image['name']} is {width}x{height}, the maximum is {limits['max_width']}x{limits['max_height']}.")
+    if width * height > limits.get('max_pixels', width * height):
+        errors.append(f"{name}: {image['name']} has too many pixels ({width}x{height}).")
+    if width < limits.get('min_width', 0):
+        errors.append(f"{name}: {image['name']} is {width}px wide, the minimum is {limits['min_width']}px.")
+    if 'min_aspect_ratio' in limits and height:
+        ratio = width / height
+        if not limits['min_aspect_ratio'] <= ratio <= limits['max_aspect_ratio']:
+            errors.append(f"{name}: {image['name']} has an aspect ratio of {ratio:.2f}, "
+                          f"allowed is {limits['min_aspect_ratio']:.2f} to {limits['max_aspect_ratio']:.2f}.")
+    if size is not None and limits.get('max_bytes') and size > limits['max_bytes']:
+        errors.append(f"{name}: {image['name']} is {size // 1024} KB, the limit is {limits['max_bytes'] // 1024} KB.")
+    return errors
+
+def validate_processed_media(post_data, paths):
+    # The byte size is only known once process_files has written the JPEGs and videos that will be
+    # uploaded; videos are checked in the variant each platform gets
+    errors = []
+    durations = {}
+    for platform in enabled_platforms(post_data):
+        limits = MEDIA_LIMITS[platform]
+        for path in paths:
+            path = media.variant(path, platform)
+            is_video = media.is_video(path)
+            max_bytes = limits.get('max_video_bytes' if is_video else 'max_bytes')
+            size = os.path.getsize(path)
+            if max_bytes and size > max_bytes:
+                errors.append(f'{platform.capitalize()}: {os.path.basename(path)} is {size // 1024} KB, '
+                              f'the limit is {max_bytes // 1024} KB.')
+            if is_video and limits.get('max_video_seconds'):
+                if path not in durations:
+                    durations[path] = media.probe(path)['duration']
+                if durations[path] > limits['max_video_seconds']:
+                    errors.append(f'{platform.capitalize()}: {os.path.basename(path)} is {durations[path]:.0f} seconds long, '
+                                  f'the limit is {limits["max_video_seconds"]} seconds.')
+    return errors